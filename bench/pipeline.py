@@ -0,0 +1,175 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from bench.stubs import StubProviders
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The main.py stages timed by the benchmark. Stages overlap when pipelined, so
+# their totals are busy time and can add up to more than the wall time.
+STAGES = [
+    "insert_story",
+    "create_image_prompt",
+    "create_title_image",
+    "create_audio",
+    "create_content_image",
+    "update_video_clip",
+    "stitch_video",
+]
+
+# Create a fresh sqlite db with every up migration applied
+def create_database(path):
+    conn = sqlite3.connect(path)
+    for migration in sorted(glob.glob(os.path.join(REPO_DIR, "migrations", "*.up.sql"))):
+        with open(migration) as f:
+            conn.executescript(f.read())
+    conn.commit()
+    conn.close()
+
+# Wrap a module function so each call adds its duration to timings[name]
+def time_stage(module, name, timings, lock):
+    fn = getattr(module, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with lock:
+                total, calls = timings.get(name, (0.0, 0))
+                timings[name] = (total + time.perf_counter() - start, calls + 1)
+
+    setattr(module, name, timed)
+
+# Run new_story end to end for one story size against stub providers in a temp
+# directory and return the results
+def run_once(args):
+    work_dir = tempfile.mkdtemp(prefix="olliepie-bench-")
+    try:
+        os.makedirs(os.path.join(work_dir, "assets"))
+        shutil.copy(os.path.join(REPO_DIR, "assets", "lullaby.mp3"), os.path.join(work_dir, "assets"))
+        shutil.copy(os.path.join(REPO_DIR, "config.toml"), work_dir)
+
+        database = os.path.join(work_dir, "olliepie.db")
+        create_database(database)
+        os.environ["DATABASE_URL"] = f"sqlite://{database}"
+        os.environ["CACHE_DISABLED"] = "1"
+        if args.workers:
+            os.environ["MAX_WORKERS"] = str(args.workers)
+        if args.encode_workers:
+            os.environ["ENCODE_WORKERS"] = str(args.encode_workers)
+
+        import main
+        from utils.metrics import flush
+        logging.getLogger().setLevel(logging.WARNING)
+
+        stubs = StubProviders(
+            work_dir,
+            pages=args.pages,
+            latency=args.latency,
+            failure_rate=args.failure_rate,
+            image_size=args.image_size,
+            audio_seconds=args.audio_seconds,
+            seed=args.seed
+        )
+        stubs.install(main)
+
+        timings = {}
+        lock = threading.Lock()
+        for stage in STAGES:
+            time_stage(main, stage, timings, lock)
+
+        os.chdir(work_dir)
+        start = time.perf_counter()
+        # A stage that runs out of attempts exits, which fails the run rather
+        # than the benchmark, keeping the timings of the stages that ran
+        error = None
+        try:
+            main.new_story(structured=args.mode == "structured", stream=args.mode == "stream")
+        except (Exception, SystemExit) as e:
+            error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - start
+        # Write the buffered metrics while the temp db still exists
+        flush()
+
+        return {
+            "pages": args.pages,
+            "mode": args.mode,
+            "error": error,
+            "wall_seconds": wall,
+            "pages_per_second": None if error else args.pages / wall,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "stages": {name: {"seconds": total, "calls": calls} for name, (total, calls) in timings.items()},
+            "provider_calls": stubs.calls,
+        }
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_result(result):
+    print(f"\n{result['pages']} pages ({result['mode']})" + (" failed" if result["error"] else ""))
+    if result["error"]:
+        print(f"  error            {result['error']}")
+    print(f"  wall time        {result['wall_seconds']:.2f}s")
+    if result["pages_per_second"] is not None:
+        print(f"  pages per second {result['pages_per_second']:.2f}")
+    print(f"  peak rss         {result['peak_rss_mb']:.1f} MB (ffmpeg {result['peak_child_rss_mb']:.1f} MB)")
+    print(f"  provider calls   {result['provider_calls']}")
+    for stage in STAGES:
+        if stage in result["stages"]:
+            timing = result["stages"][stage]
+            print(f"  {stage:<22} {timing['seconds']:>8.2f}s over {timing['calls']} calls")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark new_story end to end with local stub providers.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 200], help="Story sizes to benchmark.")
+    parser.add_argument("--mode", choices=["default", "stream", "structured"], default="default")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each stub provider call takes.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Chance that a stub provider call fails.")
+    parser.add_argument("--image-size", type=int, default=1024, help="Width and height of stub images.")
+    parser.add_argument("--audio-seconds", type=float, default=3.0, help="Length of stub page audio.")
+    parser.add_argument("--workers", type=int, help="MAX_WORKERS for the run.")
+    parser.add_argument("--encode-workers", type=int, help="ENCODE_WORKERS for the run.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print results as json.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp directory of each run.")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+# Each story size runs in its own process so peak rss is measured per size
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+
+    # A child run gets the one story size it was started for
+    if args.single:
+        args.pages = args.pages[0]
+        print(json.dumps(run_once(args)))
+        return
+
+    results = []
+    for pages in args.pages:
+        child_args = [arg for arg in (argv if argv is not None else sys.argv[1:]) if arg != "--json"]
+        command = [sys.executable, "-m", "bench.pipeline", "--single"] + child_args + ["--pages", str(pages)]
+        output = subprocess.run(command, cwd=REPO_DIR, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_result(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported by the commands that use them
+HEAVY_MODULES = [
+    "moviepy",
+    "google.generativeai",
+    "google.cloud.texttospeech",
+    "google.cloud.texttospeech_v1beta1",
+    "google.cloud.storage",
+    "vertexai",
+]
+
+# Import main.py in a fresh interpreter and return the heavy modules it loaded
+def heavy_imports():
+    code = (
+        "import sys, main; "
+        f"print('\\n'.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO_DIR, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    ).stdout
+    return [line for line in output.splitlines() if line]
+
+# Time a light CLI command in fresh interpreters and return each run in seconds
+def time_command(args, runs):
+    # Light commands still check the environment, but never use it
+    env = dict(os.environ)
+    for var in ["GOOGLE_API_KEY", "PROJECT_ID", "DATABASE_URL"]:
+        env.setdefault(var, "unused")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "main.py"] + args, cwd=REPO_DIR, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup time for light commands.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="Fail if the median startup is slower.")
+    args = parser.parse_args(argv)
+
+    failed = False
+
+    heavy = heavy_imports()
+    if heavy:
+        print(f"main.py imports heavy modules at startup: {', '.join(heavy)}")
+        failed = True
+
+    for command in [["--help"], ["--outline"], ["--prompt"]]:
+        timings = time_command(command, args.runs)
+        median = statistics.median(timings)
+        print(f"main.py {' '.join(command):<10} median {median * 1000:.0f}ms, max {max(timings) * 1000:.0f}ms")
+        if median > args.max_seconds:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
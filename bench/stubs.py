@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+# Local stand-in for a generated image, saved the same way as a vertexai GeneratedImage
+class StubImage:
+    def __init__(self, image_bytes):
+        self._image_bytes = image_bytes
+
+    def save(self, location, include_generation_parameters=False):
+        with open(location, "wb") as f:
+            f.write(self._image_bytes)
+
+# Deterministic, offline stand-ins for generate_text, generate_audio and
+# generate_image with configurable latency, failure rate and payload size. The
+# audio and image payloads are rendered once with ffmpeg so the real encoding
+# and stitching paths receive valid media.
+class StubProviders:
+    def __init__(self, work_dir, pages=10, latency=0.0, failure_rate=0.0, image_size=1024, audio_seconds=3.0, seed=0):
+        self.pages = pages
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = {"text": 0, "audio": 0, "image": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._audio = self._render(work_dir, "stub.mp3", [
+            "-f", "lavfi", "-i", "anullsrc=r=24000:cl=mono", "-t", str(audio_seconds), "-c:a", "libmp3lame"
+        ])
+        self._image = self._render(work_dir, "stub.png", [
+            "-f", "lavfi", "-i", f"testsrc=size={image_size}x{image_size}", "-frames:v", "1"
+        ])
+
+    def _render(self, work_dir, name, args):
+        path = os.path.join(work_dir, name)
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error"] + args + [path], check=True)
+        with open(path, "rb") as f:
+            return f.read()
+
+    # Sleep for the configured latency and decide whether this call fails
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+            failed = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            logger.error(f"Stub {kind} call failed")
+        return not failed
+
+    def story(self):
+        return "\n[PAGE]\n".join(f"Page {page + 1}. Bongo and Oakley go on an adventure." for page in range(self.pages))
+
+    def generate_text(self, prompt, cache=True):
+        if not self._call("text"):
+            return None
+        # The story itself is the only prompt sent as a tuple of prompt parts
+        if isinstance(prompt, tuple):
+            return self.story()
+        digest = hashlib.sha256(str(prompt).encode("utf-8")).hexdigest()
+        return f"A whimsical painted scene of two dogs by a lake, {digest[:16]}."
+
+    def generate_text_stream(self, prompt):
+        story = self.generate_text(prompt)
+        if story is None:
+            raise RuntimeError("Stub text stream failed")
+        for start in range(0, len(story), 32):
+            yield story[start:start + 32]
+
+    def generate_json(self, prompt):
+        if not self._call("text"):
+            return None
+        return {
+            "pages": [
+                {"content": page, "image_prompt": f"A whimsical painted scene for page {index + 1}."}
+                for index, page in enumerate(self.story().split("\n[PAGE]\n"))
+            ]
+        }
+
+    def generate_audio(self, text, language_code=None, voice_name=None):
+        if not self._call("audio"):
+            return None
+        return self._audio
+
+    def generate_image(self, prompt, cache=True):
+        if not self._call("image"):
+            return None
+        return StubImage(self._image)
+
+    # Replace the provider functions imported by a module with the stand-ins
+    def install(self, module):
+        for name in ["generate_text", "generate_text_stream", "generate_json", "generate_audio", "generate_image"]:
+            if hasattr(module, name):
+                setattr(module, name, getattr(self, name))
@@ -0,0 +1,73 @@
+from .utils import get_db_connection
+from collections import namedtuple
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+# A node in the story build graph. path is the file the node produces, or a
+# logical name such as story_content:1:image_prompt for values kept in the db.
+BuildNode = namedtuple("BuildNode", ["story_id", "story_content_id", "kind", "path", "input_hash"])
+
+# Look up the input hash and status recorded when an artifact was last produced
+def get_artifact(path):
+    conn, c = get_db_connection()
+    c.execute("SELECT input_hash, status FROM artifact WHERE path = ?", (path,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+# Look up the input hash recorded when an artifact was last produced
+def get_artifact_hash(path):
+    artifact = get_artifact(path)
+    return artifact[0] if artifact else None
+
+# Record the input hash and status of an artifact
+def record_artifact(story_id, story_content_id, kind, path, input_hash, status="done"):
+    conn, c = get_db_connection()
+    c.execute(
+        "INSERT INTO artifact (story_id, story_content_id, kind, path, input_hash, status) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(path) DO UPDATE SET input_hash = excluded.input_hash, status = excluded.status, "
+        "updated_at = CURRENT_TIMESTAMP",
+        (story_id, story_content_id, kind, path, input_hash, status)
+    )
+    conn.commit()
+    conn.close()
+
+# Record several finished BuildNodes in one statement
+def record_artifacts(nodes):
+    conn, c = get_db_connection()
+    c.executemany(
+        "INSERT INTO artifact (story_id, story_content_id, kind, path, input_hash, status) VALUES (?, ?, ?, ?, ?, 'done') "
+        "ON CONFLICT(path) DO UPDATE SET input_hash = excluded.input_hash, status = excluded.status, "
+        "updated_at = CURRENT_TIMESTAMP",
+        nodes
+    )
+    conn.commit()
+    conn.close()
+
+# A node is dirty when it has never finished, its inputs changed since it last
+# finished, or one of the files it produced is missing. A node with no record
+# whose outputs exist, or whose value is stored when exists is passed, was
+# built before builds were recorded: its current inputs are recorded and it
+# counts as built rather than paying to make it again.
+def node_is_dirty(node, outputs=(), exists=None):
+    for output in outputs:
+        if not output or not os.path.exists(output):
+            return True
+    artifact = get_artifact(node.path)
+    if not artifact and (exists if exists is not None else bool(outputs)):
+        logger.info(f"Recording existing {node.kind} for {node.path}")
+        record_artifact(*node)
+        return False
+    return not artifact or artifact[0] != node.input_hash or artifact[1] != "done"
+
+# Build a node and record the outcome so an interrupted build resumes here
+def run_build_node(node, build):
+    try:
+        result = build()
+    except BaseException:
+        logger.error(f"Failed to build {node.kind} for {node.path}, run --build {node.story_id} to resume")
+        record_artifact(node.story_id, node.story_content_id, node.kind, node.path, node.input_hash, status="failed")
+        raise
+    record_artifact(node.story_id, node.story_content_id, node.kind, node.path, node.input_hash)
+    return result
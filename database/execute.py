@@ -3,8 +3,9 @@ import logging
 logger = logging.getLogger(__name__)
 import datetime
 
-# Separate the story into scenes/paragraphs and save to a sqlite database
-def insert_story(story, story_prompt, story_path):
+# Separate the story into scenes/paragraphs and save to a sqlite database. When
+# pages is given as (content, image_prompt) pairs they are inserted as is.
+def insert_story(story, story_prompt, story_path, pages=None, config_path=None):
     logger.info('Inserting Story')
 
     conn, c = get_db_connection()
@@ -14,18 +15,75 @@ def insert_story(story, story_prompt, story_path):
     for prompt in story_prompt:
         prompt_string += prompt + " "
 
-    c.execute("INSERT INTO story (title, story, story_prompt, story_path) VALUES (?, ?, ?, ?)", (title, story, prompt_string, story_path))
+    c.execute(
+        "INSERT INTO story (title, story, story_prompt, story_path, config_path) VALUES (?, ?, ?, ?, ?)",
+        (title, story, prompt_string, story_path, config_path)
+    )
 
     story_id = c.lastrowid
-    
-    pages = story.split("[PAGE]")
 
-    for i in range(len(pages)):
-        if pages[i] == "":
-            continue
-        c.execute("INSERT INTO story_content (story_id, content) VALUES (?, ?)", (story_id, pages[i]))
+    if pages:
+        c.executemany(
+            "INSERT INTO story_content (story_id, content, image_prompt) VALUES (?, ?, ?)",
+            [(story_id, content, image_prompt) for content, image_prompt in pages]
+        )
+    else:
+        insert_pages(c, story_id, story)
 
     conn.commit()
     conn.close()
 
     return story_id
+
+# Split the story on [PAGE] and insert a story_content row for each page
+def insert_pages(c, story_id, story):
+    pages = story.split("[PAGE]")
+
+    c.executemany(
+        "INSERT INTO story_content (story_id, content) VALUES (?, ?)",
+        [(story_id, page) for page in pages if page != ""]
+    )
+
+# Insert a single page, returning its story_content id
+def insert_page(story_id, content):
+    conn, c = get_db_connection()
+    c.execute("INSERT INTO story_content (story_id, content) VALUES (?, ?)", (story_id, content))
+    story_content_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return story_content_id
+
+def update_story_text(story_id, story):
+    conn, c = get_db_connection()
+    c.execute("UPDATE story SET story = ? WHERE id = ?", (story, story_id))
+    conn.commit()
+    conn.close()
+
+# Save the audio paths of several pages as (story_content_id, audio_path) pairs
+def update_audio_paths(paths):
+    conn, c = get_db_connection()
+    c.executemany("UPDATE story_content SET audio_path = ? WHERE id = ?", [(path, story_content_id) for story_content_id, path in paths])
+    conn.commit()
+    conn.close()
+
+# Save the normalized image paths of several pages as (story_content_id, path) pairs
+def update_normalized_image_paths(paths):
+    conn, c = get_db_connection()
+    c.executemany(
+        "UPDATE story_content SET normalized_image_path = ? WHERE id = ?",
+        [(path, story_content_id) for story_content_id, path in paths]
+    )
+    conn.commit()
+    conn.close()
+
+# Save voice variant audio as (story_content_id, name, language_code, voice, text, audio_path) rows
+def upsert_audio_variants(variants):
+    conn, c = get_db_connection()
+    c.executemany(
+        "INSERT INTO audio_variant (story_content_id, name, language_code, voice, text, audio_path) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(story_content_id, name) DO UPDATE SET language_code = excluded.language_code, voice = excluded.voice, "
+        "text = excluded.text, audio_path = excluded.audio_path, updated_at = CURRENT_TIMESTAMP",
+        variants
+    )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,119 @@
+from .utils import get_db_connection
+import os
+import socket
+import uuid
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 120
+MAX_JOB_ATTEMPTS = 3
+
+# How long a claimed job belongs to a worker. Running workers renew their leases,
+# so a lease only runs out when the worker holding it has died.
+def get_lease_seconds():
+    return max(10, int(os.getenv('JOB_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)))
+
+# Names this worker process in the job table, unique across hosts sharing the database
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Add a job to the queue for a running --serve process
+def enqueue_job(kind, arg=None, config_path=None):
+    conn, c = get_db_connection()
+    c.execute("INSERT INTO job (kind, arg, config_path) VALUES (?, ?, ?)", (kind, arg, config_path))
+    job_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+# Queue count new stories for each config file, returning the batch id
+def enqueue_batch(config_paths, count):
+    batch = uuid.uuid4().hex[:8]
+    conn, c = get_db_connection()
+    c.executemany(
+        "INSERT INTO job (kind, config_path, batch) VALUES ('new', ?, ?)",
+        [(config_path, batch) for config_path in config_paths for _ in range(count)]
+    )
+    conn.commit()
+    conn.close()
+    return batch
+
+# Take the oldest pending job, or a running job whose worker stopped renewing its
+# lease, or None. The write lock is held while choosing the job so two workers
+# never take the same one. Jobs that have lost their worker too many times are
+# failed instead of being run again.
+def claim_job(conn, worker, lease_seconds):
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute(
+            "UPDATE job SET status = 'failed', error = 'Lease expired ' || attempts || ' times', finished_at = CURRENT_TIMESTAMP "
+            "WHERE status = 'running' AND lease_expires_at < CURRENT_TIMESTAMP AND attempts >= ?",
+            (MAX_JOB_ATTEMPTS,)
+        )
+        c.execute(
+            "SELECT id, kind, arg, config_path, worker FROM job "
+            "WHERE status = 'pending' OR (status = 'running' AND lease_expires_at < CURRENT_TIMESTAMP) "
+            "ORDER BY id LIMIT 1"
+        )
+        job = c.fetchone()
+        if job:
+            if job[4]:
+                logger.warning(f"Recovering job {job[0]} from worker {job[4]}")
+            c.execute(
+                "UPDATE job SET status = 'running', worker = ?, attempts = attempts + 1, started_at = CURRENT_TIMESTAMP, "
+                "lease_expires_at = datetime('now', ?) WHERE id = ?",
+                (worker, f"+{lease_seconds} seconds", job[0])
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return job[:4] if job else None
+
+# Push back the lease of every job this worker is still running
+def renew_leases(conn, worker, job_ids, lease_seconds):
+    if not job_ids:
+        return
+    placeholders = ", ".join("?" for _ in job_ids)
+    conn.execute(
+        f"UPDATE job SET lease_expires_at = datetime('now', ?) WHERE worker = ? AND status = 'running' AND id IN ({placeholders})",
+        (f"+{lease_seconds} seconds", worker, *job_ids)
+    )
+    conn.commit()
+
+# Mark a job done or failed. A worker whose lease was taken over no longer owns
+# the job, so its result is ignored.
+def finish_job(job_id, error=None, worker=None):
+    conn, c = get_db_connection()
+    c.execute(
+        "UPDATE job SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ? AND (? IS NULL OR worker = ?)",
+        ("failed" if error else "done", error, job_id, worker, worker)
+    )
+    conn.commit()
+    conn.close()
+
+def list_jobs(limit=20):
+    conn, c = get_db_connection()
+    c.execute(
+        "SELECT id, kind, arg, status, error, created_at, started_at, finished_at, worker FROM job ORDER BY id DESC LIMIT ?",
+        (limit,)
+    )
+    jobs = c.fetchall()
+    conn.close()
+    return jobs
+
+# Per batch job counts and the seconds from its first job starting to its last
+# job finishing, newest batch first
+def batch_throughput(limit=5):
+    conn, c = get_db_connection()
+    c.execute(
+        "SELECT batch, COUNT(*), "
+        "SUM(status = 'done'), SUM(status = 'failed'), SUM(status = 'running'), SUM(status = 'pending'), "
+        "(julianday(MAX(finished_at)) - julianday(MIN(started_at))) * 86400 "
+        "FROM job WHERE batch IS NOT NULL GROUP BY batch ORDER BY MAX(id) DESC LIMIT ?",
+        (limit,)
+    )
+    batches = c.fetchall()
+    conn.close()
+    return batches
@@ -0,0 +1,55 @@
+from .utils import get_db_connection
+from collections import namedtuple
+import logging
+logger = logging.getLogger(__name__)
+
+# A story with every page and the paths of everything built for it
+Story = namedtuple("Story", ["id", "story", "story_path", "title_image_path", "config_path", "pages"])
+Page = namedtuple("Page", ["id", "story_id", "story_path", "content", "image_prompt", "image_path", "normalized_image_path", "audio_path"])
+
+PAGE_COLUMNS = (
+    "story_content.id, story.id, story.story_path, story_content.content, story_content.image_prompt, "
+    "story_content.image_path, story_content.normalized_image_path, story_content.audio_path"
+)
+
+# Load a story and its pages in page order with one query, or None if there is
+# no such story
+def get_story_manifest(story_id):
+    conn, c = get_db_connection()
+    c.execute(
+        "SELECT story.id, story.story, story.story_path, story.title_image_path, story.config_path, "
+        f"{PAGE_COLUMNS} FROM story LEFT JOIN story_content ON story_content.story_id = story.id "
+        "WHERE story.id = ? ORDER BY story_content.id",
+        (story_id,)
+    )
+    rows = c.fetchall()
+    conn.close()
+
+    if not rows:
+        return None
+    pages = [Page(*row[5:]) for row in rows if row[5] is not None]
+    return Story(*rows[0][:5], pages)
+
+# Load a page along with its story's path, or None if there is no such page
+def get_page(story_content_id):
+    conn, c = get_db_connection()
+    c.execute(
+        f"SELECT {PAGE_COLUMNS} FROM story_content JOIN story ON story.id = story_content.story_id "
+        "WHERE story_content.id = ?",
+        (story_content_id,)
+    )
+    row = c.fetchone()
+    conn.close()
+    return Page(*row) if row else None
+
+# The voice variant audio of a story's pages, keyed by (story_content_id, name)
+def get_audio_variants(story_id):
+    conn, c = get_db_connection()
+    c.execute(
+        "SELECT audio_variant.story_content_id, audio_variant.name, audio_variant.audio_path FROM audio_variant "
+        "JOIN story_content ON story_content.id = audio_variant.story_content_id WHERE story_content.story_id = ?",
+        (story_id,)
+    )
+    rows = c.fetchall()
+    conn.close()
+    return {(story_content_id, name): audio_path for story_content_id, name, audio_path in rows}
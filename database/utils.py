@@ -1,7 +1,12 @@
 import sqlite3
 import os
+import threading
 
-def get_db_connection():
+BUSY_TIMEOUT_MS = 30000
+
+_local = threading.local()
+
+def get_db_path():
     db = os.getenv('DATABASE_URL')
 
     if not db:
@@ -11,8 +16,49 @@ def get_db_connection():
     if db.startswith("sqlite://"):
         db = db[9:]
 
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
+    return db
+
+# The connection shared by every get_db_connection call on a thread. close()
+# hands it back rather than closing it, and only the outermost close discards
+# uncommitted changes, the same as closing a connection of its own would.
+class PooledConnection(sqlite3.Connection):
+    depth = 0
+
+    def close(self):
+        self.depth = max(0, self.depth - 1)
+        if not self.depth and self.in_transaction:
+            self.rollback()
+
+# WAL lets readers carry on while another worker writes, and the busy timeout
+# makes writers wait for the lock instead of failing with "database is locked"
+def open_db_connection():
+    conn = sqlite3.connect(get_db_path(), timeout=BUSY_TIMEOUT_MS / 1000, factory=PooledConnection)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+def get_db_connection():
+    # Imported here as metrics writes to the same database
+    from utils.metrics import TimedCursor
+
+    # A forked worker process opens its own connection
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _local.conn = open_db_connection()
+        _local.pid = os.getpid()
+
+    conn.depth += 1
+    c = conn.cursor(factory=TimedCursor)
 
     return conn, c
 
+# Drop anything left open on this thread's connection by a command that exited
+# part way, so a long running worker starts its next job clean
+def reset_db_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    conn.depth = 0
+    if conn.in_transaction:
+        conn.rollback()
@@ -1,11 +1,96 @@
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import logging
 import os
+import threading
+from utils.concurrency import get_max_workers, run_concurrently, submit_in_context
+logger = logging.getLogger(__name__)
+
+# Uploads larger than one chunk are sent as resumable, chunked uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+_client = None
+_client_lock = threading.Lock()
+_background = ThreadPoolExecutor(max_workers=1)
+
+# One storage client per process. Set STORAGE_EMULATOR_HOST to use a local
+# fake-gcs-server, which does not need credentials.
+def get_storage_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import storage
+            if os.getenv('STORAGE_EMULATOR_HOST'):
+                from google.auth.credentials import AnonymousCredentials
+                _client = storage.Client(project=os.getenv('PROJECT_ID', 'test'), credentials=AnonymousCredentials())
+            else:
+                _client = storage.Client()
+        return _client
+
+def get_bucket():
+    return get_storage_client().bucket(os.getenv('BUCKET_NAME'))
 
 # Upload to GCS
 def upload_to_gcs(source_file_path, destination_blob_name):
-    bucket_name = os.getenv('BUCKET_NAME')
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+    blob = get_bucket().blob(destination_blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
     blob.upload_from_filename(source_file_path)
     print('File {} uploaded to {}.'.format(source_file_path, destination_blob_name))
+
+# Base64 md5 of a file, in the same form GCS reports it
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+# Base64 crc32c of a file, used for composite objects that have no md5
+def file_crc32c(path):
+    import google_crc32c
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+def blob_matches(blob, path):
+    if blob.md5_hash:
+        return blob.md5_hash == file_md5(path)
+    if blob.crc32c:
+        return blob.crc32c == file_crc32c(path)
+    return False
+
+# Upload every file in a story directory under the same prefix in the bucket,
+# in parallel, skipping files whose remote checksum already matches. With
+# background=True the upload runs on a background thread and a future is returned.
+def publish_story(story_dir, background=False, max_workers=None):
+    if background:
+        return submit_in_context(_background, publish_story, story_dir, False, max_workers)
+
+    logger.info(f"Publishing {story_dir}")
+    bucket = get_bucket()
+    prefix = story_dir.strip("/")
+    remote = {blob.name: blob for blob in get_storage_client().list_blobs(bucket, prefix=f"{prefix}/")}
+
+    uploads = []
+    for root, _, files in os.walk(story_dir):
+        for name in files:
+            # Skip concat lists left by an in-progress stitch
+            if name.startswith("concat-"):
+                continue
+            path = os.path.join(root, name)
+            blob_name = f"{prefix}/{os.path.relpath(path, story_dir)}"
+            if blob_name in remote and blob_matches(remote[blob_name], path):
+                continue
+            uploads.append((path, blob_name))
+
+    def upload(job):
+        path, blob_name = job
+        blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.upload_from_filename(path, checksum="md5")
+        logger.info(f"Uploaded {path} to {blob_name}")
+
+    run_concurrently(upload, uploads, max_workers or get_max_workers())
+    logger.info(f"Published {len(uploads)} new or changed files from {story_dir}")
+    return len(uploads)
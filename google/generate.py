@@ -1,68 +1,274 @@
 import os
-import google.generativeai as genai
-from google.cloud import texttospeech
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel
+import json
+import base64
+from xml.sax.saxutils import escape
+import threading
+from utils.cache import get_cache, cache_key, cache_enabled
+from utils.ratelimit import with_rate_limit
+from utils.metrics import Measurement, provider_call, record, set_outcome, payload_size
+import time
 import logging
 logger = logging.getLogger(__name__)
 
-# Generate text using the generative model
-def generate_text(prompt):
+TEXT_MODEL = 'gemini-1.5-pro-001'
+IMAGE_MODEL = 'imagegeneration@006'
+IMAGE_LOCATION = 'us-central1'
+IMAGE_ASPECT_RATIO = '1:1'
+VOICE_LANGUAGE_CODE = 'en-US'
+# VOICE_NAME = 'en-US-Studio-O'
+VOICE_NAME = 'en-US-Journey-F'
+SPEAKING_RATE = 0.65
+# Journey voices do not support SSML, so narration uses a voice that returns mark timepoints
+NARRATION_VOICE_NAME = 'en-US-Neural2-F'
+NARRATION_MAX_BYTES = 5000
+
+# Holds the provider clients so they are created once per process and shared
+# between threads instead of being rebuilt for every page. The SDKs are only
+# imported when a client is first needed, so commands that never call a
+# provider start quickly.
+class ProviderSession:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._text_model = None
+        self._tts_client = None
+        self._tts_beta_client = None
+        self._image_model = None
+
+    def text_model(self):
+        with self._lock:
+            if self._text_model is None:
+                logger.info(f"Initializing text model {TEXT_MODEL}")
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+                self._text_model = genai.GenerativeModel(TEXT_MODEL)
+            return self._text_model
+
+    def tts_client(self):
+        with self._lock:
+            if self._tts_client is None:
+                logger.info("Initializing text to speech client")
+                from google.cloud import texttospeech
+                self._tts_client = texttospeech.TextToSpeechClient()
+            return self._tts_client
+
+    def tts_beta_client(self):
+        with self._lock:
+            if self._tts_beta_client is None:
+                logger.info("Initializing text to speech beta client")
+                from google.cloud import texttospeech_v1beta1
+                self._tts_beta_client = texttospeech_v1beta1.TextToSpeechClient()
+            return self._tts_beta_client
+
+    def image_model(self):
+        with self._lock:
+            if self._image_model is None:
+                logger.info(f"Initializing image model {IMAGE_MODEL}")
+                import vertexai
+                from vertexai.preview.vision_models import ImageGenerationModel
+                vertexai.init(project=os.getenv('PROJECT_ID'), location=IMAGE_LOCATION)
+                self._image_model = ImageGenerationModel.from_pretrained(IMAGE_MODEL)
+            return self._image_model
+
+    # Create every client up front, for long running processes
+    def warm(self):
+        self.text_model()
+        self.tts_client()
+        self.image_model()
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = ProviderSession()
+        return _session
+
+# Generate text using the generative model. Pass cache=False when a fresh
+# response is wanted for an identical prompt, such as a brand new story.
+@provider_call("gemini")
+def generate_text(prompt, cache=True):
     logger.info(f"Generating text for prompt")
-    google_api_key = os.getenv('GOOGLE_API_KEY')
-    genai.configure(api_key=google_api_key)
+    key = cache_key("text", prompt, model=TEXT_MODEL)
+    if cache and cache_enabled():
+        cached = get_cache().get("text", key)
+        if cached is not None:
+            set_outcome("cache_hit")
+            return cached.decode("utf-8")
+    try:
+        model = get_session().text_model()
+        response = with_rate_limit("gemini", lambda: model.generate_content(prompt))
+        text = response.text
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return None
+    if cache and cache_enabled() and text:
+        get_cache().put("text", key, text.encode("utf-8"))
+    return text
+
+# Stream text from the generative model, yielding chunks as they arrive
+def generate_text_stream(prompt):
+    logger.info(f"Streaming text for prompt")
+    measurement = Measurement("gemini_stream", bytes_in=payload_size(prompt))
+    measurement.bytes_out = 0
+    start = time.perf_counter()
     try:
-        model = genai.GenerativeModel('gemini-1.5-pro-001')
-        response = model.generate_content(prompt)
-        return response.text
+        model = get_session().text_model()
+        for chunk in with_rate_limit("gemini", lambda: model.generate_content(prompt, stream=True)):
+            measurement.bytes_out += payload_size(chunk.text)
+            yield chunk.text
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        measurement.outcome = "error"
+        raise
+    finally:
+        record(measurement, time.perf_counter() - start)
+
+# Generate a JSON response and return it parsed, or None if the response is not valid JSON
+@provider_call("gemini_json")
+def generate_json(prompt):
+    logger.info(f"Generating json for prompt")
+    try:
+        model = get_session().text_model()
+        response = with_rate_limit("gemini", lambda: model.generate_content(
+            prompt,
+            generation_config={"response_mime_type": "application/json"}
+        ))
+        return json.loads(response.text)
     except Exception as e:
         logger.error(f"Error: {e}")
         return None
 
-def generate_audio(text):
+def clean_narration_text(text):
     text = text.replace("[PAGE]", "")
     text = text.replace("\n", " ")
+    return text
+
+# Synthesize a page. Voice variants pass their own language and voice.
+@provider_call("tts")
+def generate_audio(text, language_code=VOICE_LANGUAGE_CODE, voice_name=VOICE_NAME):
+    text = clean_narration_text(text)
     logger.info(f"Generating audio for text: " + text)
-    client = texttospeech.TextToSpeechClient()
+    key = cache_key(
+        "audio", text, language_code=language_code, voice=voice_name, speaking_rate=SPEAKING_RATE
+    )
+    if cache_enabled():
+        cached = get_cache().get("audio", key)
+        if cached is not None:
+            set_outcome("cache_hit")
+            return cached
+    from google.cloud import texttospeech
     input_text = texttospeech.SynthesisInput(text=text)
     voice = texttospeech.VoiceSelectionParams(
-        language_code="en-US",
-        # name="en-US-Studio-O",
-        name="en-US-Journey-F",
+        language_code=language_code,
+        name=voice_name,
     )
     audio_config = texttospeech.AudioConfig(
         audio_encoding=texttospeech.AudioEncoding.MP3,
-        speaking_rate=0.65
+        speaking_rate=SPEAKING_RATE
     )
     try:
-        response = client.synthesize_speech(
+        client = get_session().tts_client()
+        response = with_rate_limit("tts", lambda: client.synthesize_speech(
             request={"input": input_text, "voice": voice, "audio_config": audio_config}
-        )
-        return response.audio_content
+        ))
     except Exception as e:
         logger.error(f"Error: {e}")
         return None
+    if cache_enabled():
+        get_cache().put("audio", key, response.audio_content)
+    return response.audio_content
 
-def generate_image(prompt):
+@provider_call("imagen")
+def generate_image(prompt, cache=True):
     logger.info(f"Generating image from prompt")
-    project_id = os.getenv('PROJECT_ID')
-    vertexai.init(project=project_id, location="us-central1")
-    model = ImageGenerationModel.from_pretrained("imagegeneration@006")
+    key = cache_key("image", prompt, model=IMAGE_MODEL, aspect_ratio=IMAGE_ASPECT_RATIO)
+    if cache and cache_enabled():
+        cached = get_cache().get("image", key)
+        if cached is not None:
+            from vertexai.preview.vision_models import GeneratedImage
+            set_outcome("cache_hit")
+            return GeneratedImage(image_bytes=cached, generation_parameters={"prompt": prompt})
 
     try:
-        images = model.generate_images(
+        model = get_session().image_model()
+        images = with_rate_limit("imagen", lambda: model.generate_images(
             prompt=prompt,
             number_of_images=1,
             language="en",
-            aspect_ratio="1:1",
+            aspect_ratio=IMAGE_ASPECT_RATIO,
             safety_filter_level="block_some",
             person_generation="allow_adult",
-        )
+        ))
         if not images:
             print("No images generated")
             return
         image = images[0]
-        return image
     except Exception as e:
         print(f"Error: {e}")
         return None
+    if cache and cache_enabled():
+        get_cache().put("image", key, image._image_bytes)
+    return image
+
+# Build the SSML for a group of pages, with a mark at the start of each page
+def build_narration_ssml(pages):
+    ssml = "<speak>"
+    for story_content_id, text in pages:
+        ssml += f'<mark name="page-{story_content_id}"/>{escape(clean_narration_text(text))} '
+    return ssml + "</speak>"
+
+# Group (story_content_id, text) pages into as few narration requests as the
+# request size limit allows
+def split_narration(pages, max_bytes=NARRATION_MAX_BYTES):
+    groups = []
+    group = []
+    for page in pages:
+        if group and len(build_narration_ssml(group + [page]).encode("utf-8")) > max_bytes:
+            groups.append(group)
+            group = []
+        group.append(page)
+    if group:
+        groups.append(group)
+    return groups
+
+# Synthesize SSML in one request and return the audio with the time in seconds
+# of each mark, or None if synthesis failed
+@provider_call("tts_narration")
+def generate_narration(ssml):
+    logger.info(f"Generating narration for {len(ssml)} characters of ssml")
+    key = cache_key(
+        "narration", ssml, language_code=VOICE_LANGUAGE_CODE, voice=NARRATION_VOICE_NAME, speaking_rate=SPEAKING_RATE
+    )
+    if cache_enabled():
+        cached = get_cache().get("narration", key)
+        if cached is not None:
+            cached = json.loads(cached)
+            set_outcome("cache_hit")
+            return base64.b64decode(cached["audio"]), cached["timepoints"]
+    from google.cloud import texttospeech_v1beta1
+    try:
+        client = get_session().tts_beta_client()
+        response = with_rate_limit("tts", lambda: client.synthesize_speech(
+            request=texttospeech_v1beta1.SynthesizeSpeechRequest(
+                input=texttospeech_v1beta1.SynthesisInput(ssml=ssml),
+                voice=texttospeech_v1beta1.VoiceSelectionParams(
+                    language_code=VOICE_LANGUAGE_CODE,
+                    name=NARRATION_VOICE_NAME,
+                ),
+                audio_config=texttospeech_v1beta1.AudioConfig(
+                    audio_encoding=texttospeech_v1beta1.AudioEncoding.MP3,
+                    speaking_rate=SPEAKING_RATE
+                ),
+                enable_time_pointing=[texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK],
+            )
+        ))
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return None
+    timepoints = {timepoint.mark_name: timepoint.time_seconds for timepoint in response.timepoints}
+    if cache_enabled():
+        value = {"audio": base64.b64encode(response.audio_content).decode("ascii"), "timepoints": timepoints}
+        get_cache().put("narration", key, json.dumps(value).encode("utf-8"))
+    return response.audio_content, timepoints
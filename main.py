@@ -1,15 +1,28 @@
 import datetime
 import click
+import functools
 import os
 from dotenv import load_dotenv
-from google.generate import generate_text, generate_audio, generate_image
-from moviepy.editor import ImageClip, AudioFileClip, VideoFileClip, concatenate_videoclips, CompositeAudioClip
-from moviepy.audio.fx import audio_loop
-from database.utils import get_db_connection
-from utils.parse import check_env_vars, get_config
-from database.execute import insert_story
+from google.generate import get_session, generate_text, generate_text_stream, generate_json, generate_audio, generate_image, generate_narration, build_narration_ssml, split_narration, VOICE_LANGUAGE_CODE, VOICE_NAME, NARRATION_VOICE_NAME, SPEAKING_RATE
+from database.utils import get_db_connection, reset_db_connection
+from utils.parse import DEFAULT_CONFIG_PATH, check_env_vars, get_config, get_config_version, get_voice_variants, parse_structured_story, PageSplitter
+from database.execute import insert_story, insert_pages, insert_page, update_story_text, update_audio_paths, update_normalized_image_paths, upsert_audio_variants
+from database.manifest import get_story_manifest, get_page, get_audio_variants
+from database.jobs import get_lease_seconds, get_worker_id, enqueue_job, enqueue_batch, claim_job, renew_leases, finish_job, list_jobs, batch_throughput
+from database.artifacts import BuildNode, get_artifact_hash, record_artifact, record_artifacts, node_is_dirty, run_build_node
+from utils.cache import get_cache
+from utils.concurrency import Pipeline, get_max_workers, run_concurrently
+from utils.context import PromptContext, estimate_tokens
+from utils.estimate import estimate_new_story, estimate_audios
+from utils.hash import hash_file, hash_inputs
+from utils.metrics import page_stage, story_stage, note_retry, profile_report
+from video.hls import read_media_playlist, write_story_playlist, write_chapters, write_chapter_list, write_master_playlist, get_peak_bandwidth
+from video.encode import RENDER_PROFILES, get_clip_path, encode_title_clip, segment_clip, get_still_path, get_track_path, probe_duration, get_page_duration, encode_still, build_narration_track, render_final_tracks, get_encode_workers, get_encode_image_path, get_normalized_path, is_normalized, normalize_image, run_in_pool, encode_clip, encode_clips, clip_is_newer, concat_clips, render_final, cut_audio
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from time import sleep
+import multiprocessing
+import threading
+import time
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(name)s - %(message)s')
@@ -17,17 +30,35 @@ logger = logging.getLogger(__name__)
 
 @click.command()
 @click.option('--new', is_flag=True, help='Generate a new story.')
+@click.option('--stream', is_flag=True, help='With --new, start building each page while the rest of the story is still being written.')
+@click.option('--structured', is_flag=True, help='With --new, generate the story and every image prompt in one request.')
+@click.option('--config', type=click.Path(exists=True, dir_okay=False), multiple=True, help='With --new, --prompt or --batch, use this config file instead of config.toml. Repeat for --batch.')
+@click.option('--estimate', is_flag=True, help='With --new or --update-audios, view the expected calls, tokens and time instead of running.')
 @click.option('--prompt', is_flag=True, help='View the current prompts.')
 @click.option('--outline', is_flag=True, help='View the outline for the story.')
 @click.option("--update-image", type=int, help="Update the image for a specific story content id.")
 @click.option("--update-audio", type=int, help="Update the audio for a specific story content id.")
 @click.option("--update-audios", type=int, help="Create audio files for a specific story id.")
+@click.option('--batch-tts', is_flag=True, help='With --update-audios, narrate the story in as few requests as possible.')
+@click.option('--variants', type=int, help='Narrate a story in every voice in its config and render one video with a track per voice. Provide the story id as an argument.')
 @click.option('--create-videos', type=int, help='Create video clips for a specific story id.')
 @click.option('--create-video', type=int, help='Create a video clip for a specific story content id.')
 @click.option('--stitch', type=int, help='Stitch the video together. Provide the story id as an argument.')
+@click.option('--hls', type=int, help='Write a story as HLS segments cut along its pages, with chapters. Provide the story id as an argument.')
+@click.option('--preview', is_flag=True, help='With --create-videos, --create-video, --stitch, --variants or --hls, render a fast low quality preview.')
+@click.option('--build', type=int, help='Regenerate only the out of date parts of a story. Provide the story id as an argument.')
+@click.option('--publish', is_flag=True, help='With --new or --build, upload the story to the bucket while it renders. With --hls, upload the changed segments.')
+@click.option('--publish-story', type=int, help='Upload the files of a story to the bucket. Provide the story id as an argument.')
+@click.option('--serve', is_flag=True, help='Run a long lived worker that keeps clients warm and runs queued jobs.')
+@click.option('--workers', type=int, default=1, help='With --serve, the number of worker processes to start.')
+@click.option('--batch', type=int, help='Queue this many new stories for each --config file, to be made by --serve workers.')
+@click.option('--submit', type=str, help='Queue a job for --serve as kind or kind:id, e.g. build:12. See --jobs for kinds.')
+@click.option('--jobs', is_flag=True, help='View recent jobs and the job kinds.')
+@click.option('--profile', type=int, help='View where time was spent generating a story. Provide the story id as an argument.')
+@click.option('--cache-stats', is_flag=True, help='View response cache hits, misses and size.')
 @click.help_option('-h', '--help')
 
-def main(new, prompt, outline, stitch, create_videos, create_video, update_image, update_audio, update_audios):
+def main(new, stream, structured, config, estimate, prompt, outline, stitch, hls, preview, create_videos, create_video, update_image, update_audio, update_audios, batch_tts, variants, build, publish, publish_story, serve, workers, batch, submit, jobs, profile, cache_stats):
     logger.info('Olliepie Storybook Generator')
 
     if check_env_vars() == False:
@@ -35,46 +66,110 @@ def main(new, prompt, outline, stitch, create_videos, create_video, update_image
         exit(1)
 
     if new:
-        new_story()
+        if stream and structured:
+            logger.error("--stream and --structured can not be used together")
+            exit(1)
+        if estimate:
+            print("\n".join(estimate_new_story(
+                get_prompts(get_config_path(config)), create_outline(), structured, get_max_workers(), get_encode_workers()
+            )))
+            return
+        new_story(structured, stream, publish, get_config_path(config))
     if prompt:
-        result = get_prompts()
+        result = get_prompts(get_config_path(config))
         print(result)
         return
     if outline:
         result = create_outline()
         print(result)
         return
+    if build:
+        print("Building story", build)
+        build_story(build, publish)
+        return
+    if publish_story:
+        print("Publishing story", publish_story)
+        publish_story_files(publish_story)
+        return
+    if serve:
+        serve_workers(workers, get_max_jobs())
+        return
+    if batch:
+        config_paths = [os.path.abspath(path) for path in config] or [os.path.abspath(DEFAULT_CONFIG_PATH)]
+        print("Queued batch", enqueue_batch(config_paths, batch))
+        return
+    if submit:
+        kind, _, arg = submit.partition(":")
+        if kind not in JOB_HANDLERS:
+            logger.error(f"Unknown job kind {kind}, expected one of {', '.join(JOB_HANDLERS)}")
+            exit(1)
+        if kind == "new" and arg:
+            logger.error("new jobs take no id, use --config to choose the story config")
+            exit(1)
+        if kind != "new" and not arg.isdigit():
+            logger.error(f"{kind} jobs need a story or story content id, written as {kind}:id")
+            exit(1)
+        print("Queued job", enqueue_job(kind, int(arg) if arg else None, get_config_path(config)))
+        return
+    if jobs:
+        print_jobs()
+        return
+    if profile:
+        print("\n".join(profile_report(profile)))
+        return
+    if cache_stats:
+        print_cache_stats()
+        return
     if update_image:
         print("Updating image for story content id", update_image)
-        create_content_image(update_image)
+        create_content_image(update_image, cache=False)
+        normalize_content_image(update_image)
         return
+    render_profile = "preview" if preview else "final"
     if stitch:
         print("Stitching video")
-        stitch_video(stitch)
+        stitch_video(stitch, create_videos=preview, profile=render_profile)
+        return
+    if hls:
+        print("Creating HLS for story id", hls)
+        create_hls(hls, render_profile)
+        if publish:
+            publish_story_files(hls)
+        return
+    if variants:
+        print("Creating voice variants for story id", variants)
+        create_variant_audios(variants)
+        stitch_variants(variants, render_profile)
         return
     if create_videos:
         print("Creating video clips")
-        create_video_clips(create_videos)
+        create_video_clips(create_videos, render_profile)
         return
     if create_video:
         print("Creating video clip")
-        create_video_clip(create_video)
+        create_video_clip(create_video, create_videos=True, profile=render_profile)
         return
     if update_audio:
         print("Updating audio for story content id", update_audio)
         create_audio(update_audio)
         return
     if update_audios:
+        if estimate:
+            print("\n".join(estimate_update_audios(update_audios, batch_tts)))
+            return
         print("Creating audio files for story id", create_audios)
-        create_audios(update_audios)
+        if batch_tts:
+            create_narrated_audios(update_audios)
+        else:
+            create_audios(update_audios)
         return
     else:
         print("Use --help to see available options")
         return
 
-def new_story():
+def new_story(structured=False, stream=False, publish=False, config_path=None):
     # Set the prompt for the generative model
-    prompt = get_prompts()
+    prompt = get_prompts(config_path)
 
     # Get the outline
     outline = create_outline()
@@ -83,29 +178,92 @@ def new_story():
         prompt[0] + " " + prompt[1] + " " + prompt[2] + " " + prompt[3] + " ",
         f"Write a whimsical children's story based on the following outline: {outline}"
     )
-    # Generate the content
-    story = generate_text(outline_with_prompt)
+
+    if stream:
+        new_story_streamed(outline_with_prompt, publish, config_path)
+        return
+
+    pages = None
+    if structured:
+        # Generate the pages and their image prompts in a single response
+        outline_with_prompt += (create_structured_prompt(),)
+        pages = parse_structured_story(generate_json(outline_with_prompt))
+        if not pages:
+            logger.error("Failed to generate structured story")
+            exit(1)
+        story = "\n[PAGE]\n".join(page[0] for page in pages)
+    else:
+        # Generate the content, skipping the cache so every run gets a new story
+        story = generate_text(outline_with_prompt, cache=False)
 
     # Save the response to a text file with todays date
     story_path = save_story(story)
 
     # Save the story to a database
-    story_id = insert_story(story, outline_with_prompt, story_path)
-
-    # Generate the title image
-    create_title_image(story_id, story_path)
-
-    # Get the audio
-    create_audios(story_id)
-
-    # Get the images
-    create_content_images(story_id)
-
-    # Create video clips
-    create_video_clips(story_id)
-
-    # Generate the video
-    stitch_video(story_id, create_videos=True)
+    story_id = insert_story(story, outline_with_prompt, story_path, pages, config_path)
+    record_artifact(*get_pages_node(story_id, story_path, story))
+
+    if structured:
+        record_image_prompts(story_id)
+
+    # Generate the title image, audio, images, video clips and final video. If a
+    # step fails, --build resumes from the last finished step.
+    build_story(story_id, publish)
+
+# Stream the story and start building each page as soon as its [PAGE] marker arrives
+def new_story_streamed(outline_with_prompt, publish=False, config_path=None):
+    story_path = save_story("")
+    story_id = insert_story("", outline_with_prompt, story_path, config_path=config_path)
+    upload = start_publish(story_path) if publish else None
+
+    splitter = PageSplitter()
+    contents = []
+
+    with Pipeline({"api": get_max_workers(), "encode": get_encode_workers()}) as pipeline:
+        build = StoryBuild(story_id, story_path, pipeline)
+
+        def add_pages(pages):
+            for content in pages:
+                contents.append(content)
+                build.add_page(insert_page(story_id, content), content)
+
+        try:
+            for chunk in generate_text_stream(outline_with_prompt):
+                add_pages(splitter.feed(chunk))
+        except Exception:
+            logger.error(f"Failed to generate story, run --build {story_id} after fixing the story text")
+            pipeline.wait()
+            exit(1)
+        add_pages(splitter.finish())
+
+        # Save the full story now that the stream has ended
+        with open(f"{story_path}/story.txt", "w") as f:
+            f.write(splitter.text)
+        update_story_text(story_id, splitter.text)
+        record_artifact(*get_pages_node(story_id, story_path, splitter.text))
+
+        build.add_title(contents)
+        build.finish()
+        pipeline.wait()
+
+    if upload:
+        finish_publish(upload, story_path)
+
+    logger.info(f'Story {story_id} is up to date')
+
+def create_structured_prompt():
+    return (
+        "Instead of inserting [PAGE], respond with JSON in the form "
+        '{"pages": [{"content": "...", "image_prompt": "..."}]} with one entry per page in order. '
+        "content is the text of the page. "
+        "image_prompt is a prompt to generate the image for the page of a whimsical children's storybook. "
+        "Each image prompt should not exceed 128 tokens and should utilize as many of the 128 tokens as possible. "
+        "Do not use markdown, labels, or titles in the image prompt. Simply create a paragraph. "
+        "The image should be colorful, engaging, and whimsical. The image should be drawn, painted, or illustrated - always animated. "
+        "Each image prompt should include Style, Setting, Characters and keep them consistent with the other pages. "
+        "Explicitly describe each character and scene in verbose detail. Do not summarize or use general terms. "
+        "Never show people in the image."
+    )
 
 # Use AI to create an outline based on the prompts
 def create_outline():
@@ -141,10 +299,33 @@ def create_outline():
     )
     return outline
 
-def get_prompts():
+def print_cache_stats():
+    rows, size = get_cache().stats()
+    for kind, hits, misses, bytes_saved in rows:
+        print(f"{kind}: {hits} hits, {misses} misses, {bytes_saved} bytes saved")
+    print(f"{size[0]} entries, {size[1]} bytes cached")
+
+# Stories remember the config file they were written from, stored as an
+# absolute path, so later stages use the same characters.
+def get_config_path(config):
+    return os.path.abspath(config[0]) if config else None
+
+def get_story_prompts(story_id):
+    conn, c = get_db_connection()
+    c.execute("SELECT config_path FROM story WHERE id = ?", (story_id,))
+    row = c.fetchone()
+    conn.close()
+    return get_prompts(row[0] if row else None)
+
+def get_prompts(config_path=None):
     logger.info('Getting Prompts')
+    return compile_prompts(config_path, get_config_version(config_path))
 
-    config = get_config()
+# The prompts are built once per config file and version rather than on every
+# call. version is only part of the cache key.
+@functools.lru_cache(maxsize=None)
+def compile_prompts(config_path, version):
+    config = get_config(config_path)
 
     if not config:
         logger.error("Failed to get config")
@@ -200,67 +381,101 @@ def get_prompts():
 
     return (designation_prompt, characters_prompt, notes_prompt, plot_prompt)
 
-def create_audio(story_content_id):
+@page_stage("audio")
+def create_audio(story_content_id, voice_name=VOICE_NAME):
     logger.info("Generating Audio for Story Content")
-    conn, c = get_db_connection()
-    c.execute("SELECT content FROM story_content WHERE id = ?", (story_content_id,))
-    content = c.fetchone()
-
-    c.execute("SELECT story_path FROM story WHERE id = (SELECT story_id FROM story_content WHERE id = ?)", (story_content_id,))
-    story = c.fetchone()
+    page = get_page(story_content_id)
 
     response = None
     attempts = 0
 
     while not response and attempts < 3:
+        if attempts:
+            note_retry()
         attempts += 1
-        response = generate_audio(content[0])
+        response = generate_audio(page.content, VOICE_LANGUAGE_CODE, voice_name)
 
     if not response:
-        # Attempt once more in case we hit the rate limit
-        sleep(60)
-        response = generate_audio(content[0])
-        if not response:
-            logger.error(f"Failed to generate audio for content {story_content_id}")
-            exit(1)
+        logger.error(f"Failed to generate audio for content {story_content_id}")
+        exit(1)
 
-    file_name = f"{story[0]}/content-{story_content_id}.mp3"
+    file_name = f"{page.story_path}/content-{story_content_id}.mp3"
     with open(file_name, "wb") as out:
         out.write(response)
 
-    c.execute("UPDATE story_content SET audio_path = ? WHERE id = ?", (file_name, story_content_id))
+    update_audio_paths([(story_content_id, file_name)])
 
-    conn.commit()
-    conn.close()
 
 
+def estimate_update_audios(story_id, batch_tts=False):
+    story = get_story_manifest(story_id)
+    if not story:
+        logger.error(f"Story {story_id} not found")
+        exit(1)
+    pages = [(page.id, page.content) for page in story.pages]
+    narration_groups = len(split_narration(pages)) if batch_tts else None
+    return estimate_audios([content for _, content in pages], get_max_workers(), narration_groups)
 
 # Generate audio files for story
+@story_stage("audios")
 def create_audios(story_id):
     logger.info('Creating Audio Files')
 
-    conn, c = get_db_connection()
-
-    c.execute("SELECT id, content FROM story_content WHERE story_id = ?", (story_id,))
-
-    rows = c.fetchall()
-
-    for row in rows:
-        create_audio(row[0])
-
-    conn.commit()
-    conn.close()
-
+    story = get_story_manifest(story_id)
+
+    # Each page is synthesized on its own worker and saved as soon as it finishes
+    run_concurrently(create_audio, [page.id for page in story.pages])
+
+# Narrate the whole story in as few requests as possible, with an SSML mark at
+# the start of every page, then cut the narration into per-page files at the
+# mark timepoints. Groups missing timepoints fall back to one request per page
+# in the narration voice, so the whole story keeps one narrator.
+@story_stage("narrated_audios")
+def create_narrated_audios(story_id):
+    logger.info('Creating Narrated Audio Files')
+
+    story = get_story_manifest(story_id)
+    story_path = story.story_path
+    rows = [(page.id, page.content) for page in story.pages]
+
+    def narrate(indexed_group):
+        index, group = indexed_group
+        result = generate_narration(build_narration_ssml(group))
+        timepoints = result[1] if result else {}
+        if not result or any(f"page-{page[0]}" not in timepoints for page in group):
+            logger.warning(f"Narration {index} is missing page timepoints, generating audio per page")
+            run_concurrently(lambda page: create_audio(page[0], NARRATION_VOICE_NAME), group)
+            record_artifacts([get_audio_node(story_id, story_content_id, story_path, content, NARRATION_VOICE_NAME) for story_content_id, content in group])
+            return
+
+        narration_path = f"{story_path}/narration-{index}.mp3"
+        with open(narration_path, "wb") as out:
+            out.write(result[0])
+
+        audio_paths = []
+        for position, (story_content_id, content) in enumerate(group):
+            start = timepoints[f"page-{story_content_id}"]
+            end = timepoints[f"page-{group[position + 1][0]}"] if position + 1 < len(group) else None
+            file_name = f"{story_path}/content-{story_content_id}.mp3"
+            cut_audio(narration_path, file_name, start, end)
+            audio_paths.append((story_content_id, file_name))
+
+        update_audio_paths(audio_paths)
+        record_artifacts([get_audio_node(story_id, story_content_id, story_path, content, NARRATION_VOICE_NAME) for story_content_id, content in group])
+
+        os.remove(narration_path)
+
+    run_concurrently(narrate, list(enumerate(split_narration(rows))))
+
+@story_stage("title_image")
 def create_title_image(story_id, story_dir):
     logger.info('Generating Title Image')
 
-    conn, c = get_db_connection()
-
-    # Get all the content for the story
-    c.execute("SELECT content FROM story_content WHERE story_id = ?", (story_id,))
-    rows = c.fetchall()
+    manifest = get_story_manifest(story_id)
 
-    context = get_prompts()
+    # Only the story and character background, not the storyteller instructions
+    context = " ".join(get_prompts(manifest.config_path)[1:])
+    story = "\n".join(page.content.strip() for page in manifest.pages)
 
     prompt = (
         "You are an prompt engineer writing a prompt to generate images for a whimsical children's storybook."
@@ -269,129 +484,147 @@ def create_title_image(story_id, story_dir):
         "The image should capture the essence of the story and be suitable for children aged 2-6 years old."
         "The image should be colorful, engaging, and whimsical."
         f"Background Information: ```{context}```\n"
-        f"Story: ```{rows}``` End Story"
+        f"Story: ```{story}``` End Story"
     )
 
+    logger.info(f"Title image prompt request is ~{estimate_tokens(prompt)} tokens")
+
     image_prompt = generate_text(prompt)
 
     # Save Image Prompt
+    conn, c = get_db_connection()
     c.execute("UPDATE story SET title_image_prompt = ? WHERE id = ?", (image_prompt, story_id))
     conn.commit()
+    conn.close()
 
     image = None
 
     attempts = 0
 
     while not image and attempts < 3:
+        if attempts:
+            note_retry()
         attempts += 1
         image = generate_image(image_prompt)
 
     if not image:
-        # Attempt once more in case we hit the rate limit
-        sleep(60)
-        image = generate_image(image_prompt)
-        if not image:
-            logger.error("Failed to generate image for title page")
-            exit(1)
+        logger.error("Failed to generate image for title page")
+        exit(1)
 
     output_file = f"{story_dir}/title.png"
     image.save(location=output_file, include_generation_parameters=False)
 
+    conn, c = get_db_connection()
     c.execute("UPDATE story SET title_image_path = ? WHERE id = ?", (output_file, story_id))
-
     conn.commit()
     conn.close()
 
-def create_content_image(story_content_id):
+# cache=False asks Imagen for a new image even when the prompt is unchanged
+@page_stage("image")
+def create_content_image(story_content_id, cache=True):
     logger.info('Creating Content Image')
 
-    conn, c = get_db_connection()
-
-    c.execute("SELECT image_prompt, story_id FROM story_content WHERE id = ?", (story_content_id,))
-
-    content = c.fetchone()
-    story = c.execute("SELECT story_path FROM story WHERE id = ?", (content[1],)).fetchone()
+    page = get_page(story_content_id)
 
     image = None
 
     attempts = 0
 
     while not image and attempts < 3:
+        if attempts:
+            note_retry()
         attempts += 1
-        image = generate_image(content[0])
+        image = generate_image(page.image_prompt, cache=cache)
 
     if not image:
-        # Attempt once more in case we hit the rate limit
-        sleep(60)
-        image = generate_image(content[0])
-        if not image:
-            logger.error(f"Failed to generate image for content {story_content_id}")
-            exit(1)
+        logger.error(f"Failed to generate image for content {story_content_id}")
+        exit(1)
 
-    output_file = f"{story[0]}/content-img-{story_content_id}.png"
+    output_file = f"{page.story_path}/content-img-{story_content_id}.png"
     image.save(location=output_file, include_generation_parameters=False)
 
+    conn, c = get_db_connection()
     c.execute("UPDATE story_content SET image_path = ? WHERE id = ?", (output_file, story_content_id))
-
     conn.commit()
     conn.close()
 
+# Resize a page image to the video resolution once so encodes read a small jpeg
+@page_stage("normalize")
+def normalize_content_image(story_content_id):
+    page = get_page(story_content_id)
 
-def create_content_images(story_id):
-    logger.info('Generating Content Images')
+    if not page.image_path or is_normalized(page.image_path, page.normalized_image_path):
+        return
 
-    conn, c = get_db_connection()
+    normalized_path = normalize_image(page.image_path, get_normalized_path(page.image_path))
+    update_normalized_image_paths([(story_content_id, normalized_path)])
 
-    c.execute("SELECT id, content FROM story_content WHERE story_id = ?", (story_id,))
-    rows = c.fetchall()
-
-    prompts = get_prompts();
-    characters_prompt = prompts[1]
-
-    previous_prompts = []
-
-    for row in rows:
-        prompt = (
-            "You are an prompt engineer writing a prompt to generate images for a whimsical children's storybook." 
-            "The final image prompt should not exceed 128 tokens and should utilize as many of the 128 tokens as possible."
-            "Do not use markdown, labels, or titles as to avoid exceeding the token limit. Simply create a paragraph."
-            "Write a prompt to generate an image for the following scene of a whimiscal children's storybook."
-            "The image should be colorful, engaging, and whimsical. The image should be drawn, painted, or illustrated - always animated."
-            "Prompt should include Style, Setting, Characters."
-            "Use the character context, previous image prompts, and following scene to write the prompt for the image."
-            "Explicitly describe each character and scene in verbose detail. Do not summarize or use general terms."
-            "Never show people in the image."
-            f"Character Context: ```{characters_prompt}```\n"
-            f"Previous Image Prompts: ```{previous_prompts}``` End Previous Image Prompts\n"
-            f"Write a prompt for the following scene: ```{row[1]}``` End Scene"
-        )
+# Fold newly written image prompts into the running style and character summary
+def summarize_image_prompts(summary, image_prompts):
+    prompt = (
+        "You are maintaining a compact style guide for the illustrations of a whimsical children's storybook."
+        "Update the current summary with the new image prompts. Keep the art style, color palette, setting and the exact "
+        "visual description of each recurring character. Do not exceed 120 words. Simply create a paragraph."
+        f"Current Summary: ```{summary}``` End Current Summary\n"
+        f"New Image Prompts: ```{image_prompts}``` End New Image Prompts"
+    )
+    return generate_text(prompt)
 
-        image_prompt = generate_text(prompt)
+def create_prompt_context():
+    return PromptContext(summarize_image_prompts)
 
-        previous_prompts.append(image_prompt)
+# Write the image prompt for a page, using a bounded context of the earlier pages
+@page_stage("image_prompt")
+def create_image_prompt(story_content_id, content, characters_prompt, prompt_context):
+    prompt = (
+        "You are an prompt engineer writing a prompt to generate images for a whimsical children's storybook." 
+        "The final image prompt should not exceed 128 tokens and should utilize as many of the 128 tokens as possible."
+        "Do not use markdown, labels, or titles as to avoid exceeding the token limit. Simply create a paragraph."
+        "Write a prompt to generate an image for the following scene of a whimiscal children's storybook."
+        "The image should be colorful, engaging, and whimsical. The image should be drawn, painted, or illustrated - always animated."
+        "Prompt should include Style, Setting, Characters."
+        "Use the character context, style summary, previous image prompts, and following scene to write the prompt for the image."
+        "Explicitly describe each character and scene in verbose detail. Do not summarize or use general terms."
+        "Never show people in the image."
+        f"Character Context: ```{characters_prompt}```\n"
+        f"{prompt_context}"
+        f"Write a prompt for the following scene: ```{content}``` End Scene"
+    )
 
-        if not image_prompt:
-            logger.error(f"Failed to generate image prompt for content {row[0]}")
-            exit(1)
+    logger.info(f"Image prompt request for content {story_content_id} is ~{estimate_tokens(prompt)} tokens")
 
-        # Save Image Prompt
-        c.execute("UPDATE story_content SET image_prompt = ? WHERE id = ?", (image_prompt, row[0]))
-        conn.commit()
+    image_prompt = generate_text(prompt)
 
-        create_content_image(row[0])
+    if not image_prompt:
+        logger.error(f"Failed to generate image prompt for content {story_content_id}")
+        exit(1)
 
+    # Save Image Prompt
+    conn, c = get_db_connection()
+    c.execute("UPDATE story_content SET image_prompt = ? WHERE id = ?", (image_prompt, story_content_id))
     conn.commit()
     conn.close()
 
+    return image_prompt
+
 # Save the story to a text file in the stories directory
 def save_story(story):
     logger.info('Saving Story')
 
     date = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
 
+    # Workers can start stories in the same second, so each gets its own
+    # directory with a numbered suffix when the name is taken
+    os.makedirs("stories", exist_ok=True)
     directory = f"stories/{date}"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(directory, exist_ok=False)
+            break
+        except FileExistsError:
+            suffix += 1
+            directory = f"stories/{date}_{suffix}"
 
     # Make directory inside stories for content
     with open(f"{directory}/story.txt", "w") as f:
@@ -399,79 +632,572 @@ def save_story(story):
 
     return directory
 
-def create_video_clip(story_content_id, create_videos=False):
-    logger.info('Creating Video Clip')
-
-    conn, c = get_db_connection()
+def get_clip_input_hash(image_path, audio_path):
+    return hash_inputs(hash_file(image_path), hash_file(audio_path))
 
-    c.execute("SELECT content, audio_path, image_path FROM story_content WHERE id = ?", (story_content_id,))
-    story_content = c.fetchone()
-    c.execute("SELECT story_path FROM story WHERE id = (SELECT story_id FROM story_content WHERE id = ?)", (story_content_id,))
-    story_path = c.fetchone()
+@page_stage("clip")
+def create_video_clip(story_content_id, create_videos=False, profile="final"):
+    logger.info('Creating Video Clip')
 
-    clip_path = f"{story_path[0]}/content-video-{story_content_id}.mp4"
+    page = get_page(story_content_id)
+    image_path = get_encode_image_path(page.image_path, page.normalized_image_path)
+    clip_path = get_clip_path(page.story_path, story_content_id, profile)
 
     if create_videos:
-        os.system(f"ffmpeg -loop 1 -i '{story_content[2]}' -i '{story_content[1]}' -c:v libx264 -tune stillimage -c:a aac -b:a 192k -pix_fmt yuv420p -shortest '{clip_path}'")
-
-    conn.close()
+        encode_clip(image_path, page.audio_path, clip_path, page.story_id, story_content_id, profile)
+        input_hash = get_clip_input_hash(image_path, page.audio_path)
+        record_artifact(page.story_id, story_content_id, f"{profile}_clip", clip_path, input_hash)
 
     return clip_path
 
-def create_video_clips(story_id):
+# Return the input hash of a page clip if it needs encoding, otherwise None. A
+# clip is current when it is newer than its image and audio, or when they still
+# hash to the value recorded the last time it was encoded. The mtimes are
+# checked first so the inputs are only read when a file was touched.
+def get_stale_clip_hash(clip_path, image_path, audio_path):
+    if clip_is_newer(clip_path, [image_path, audio_path]):
+        logger.info(f"Skipping unchanged clip {clip_path}")
+        return None
+    input_hash = get_clip_input_hash(image_path, audio_path)
+    if os.path.exists(clip_path) and input_hash == get_artifact_hash(clip_path):
+        logger.info(f"Skipping unchanged clip {clip_path}")
+        return None
+    return input_hash
+
+# Encode a page clip in this thread if its image or audio changed
+@story_stage("clip")
+def update_video_clip(story_id, story_content_id, story_path, profile="final"):
+    original_image_path = f"{story_path}/content-img-{story_content_id}.png"
+    image_path = get_encode_image_path(original_image_path, get_normalized_path(original_image_path))
+    audio_path = f"{story_path}/content-{story_content_id}.mp3"
+    clip_path = get_clip_path(story_path, story_content_id, profile)
+    input_hash = get_stale_clip_hash(clip_path, image_path, audio_path)
+    if input_hash:
+        encode_clip(image_path, audio_path, clip_path, story_id, story_content_id, profile)
+        record_artifact(story_id, story_content_id, f"{profile}_clip", clip_path, input_hash)
+
+@story_stage("clips")
+def create_video_clips(story_id, profile="final"):
     logger.info('Creating Video Clips')
 
-    conn, c = get_db_connection()
+    story = get_story_manifest(story_id)
+
+    # Only encode clips whose image or audio changed since they were last encoded
+    jobs = []
+    input_hashes = {}
+    for page in story.pages:
+        image_path = get_encode_image_path(page.image_path, page.normalized_image_path)
+        clip_path = get_clip_path(story.story_path, page.id, profile)
+        input_hash = get_stale_clip_hash(clip_path, image_path, page.audio_path)
+        if not input_hash:
+            continue
+        input_hashes[clip_path] = (page.id, input_hash)
+        jobs.append((image_path, page.audio_path, clip_path, story_id, page.id, profile))
+
+    def on_done(job):
+        story_content_id, input_hash = input_hashes[job[2]]
+        record_artifact(story_id, story_content_id, f"{profile}_clip", job[2], input_hash)
+
+    encode_clips(jobs, on_done)
+
+def get_image_prompt_node(story_id, story_content_id, content):
+    return BuildNode(story_id, story_content_id, "image_prompt", f"story_content:{story_content_id}:image_prompt", hash_inputs(content))
+
+# Mark image prompts that were generated along with the story as built
+def record_image_prompts(story_id):
+    story = get_story_manifest(story_id)
+    record_artifacts([get_image_prompt_node(story_id, page.id, page.content) for page in story.pages if page.image_prompt])
+
+# Schedules the build of a story's pages on a Pipeline. Every stage starts as
+# soon as its inputs exist: the title image runs alongside the pages, each page
+# clip is encoded once its image and audio are ready, and the final video waits
+# only on the clips. Pages can be added while the story is still being written.
+class StoryBuild:
+    def __init__(self, story_id, story_path, pipeline):
+        self.story_id = story_id
+        self.story_path = story_path
+        self.pipeline = pipeline
+        self.characters_prompt = get_story_prompts(story_id)[1]
+        self.prompt_context = create_prompt_context()
+        self.story_content_ids = []
+        self.prompt_future = None
+        self.title_future = None
+        self.clip_futures = []
+
+    def add_page(self, story_content_id, content, image_prompt=None):
+        self.story_content_ids.append(story_content_id)
+        self.prompt_future = self.pipeline.submit(
+            self.build_image_prompt, story_content_id, content, image_prompt, after=[self.prompt_future], pool="api"
+        )
+        image_future = self.pipeline.submit(self.build_image, story_content_id, self.prompt_future, after=[self.prompt_future], pool="api")
+        normalize_future = self.pipeline.submit(normalize_content_image, story_content_id, after=[image_future], pool="encode")
+        audio_future = self.pipeline.submit(self.build_audio, story_content_id, content, pool="api")
+        self.clip_futures.append(
+            self.pipeline.submit(update_video_clip, self.story_id, story_content_id, self.story_path, after=[normalize_future, audio_future], pool="encode")
+        )
+
+    def add_title(self, contents):
+        node = BuildNode(self.story_id, None, "title_image", f"{self.story_path}/title.png", hash_inputs(*contents))
+        if node_is_dirty(node, [node.path]):
+            self.title_future = self.pipeline.submit(
+                run_build_node, node, lambda: create_title_image(self.story_id, self.story_path), pool="api"
+            )
+
+    def finish(self):
+        return self.pipeline.submit(self.build_final, after=[self.title_future] + self.clip_futures, pool="encode")
+
+    # Image prompts are written in page order. A prompt is rebuilt when its page
+    # content changes; the earlier prompts are context rather than inputs.
+    def build_image_prompt(self, story_content_id, content, image_prompt):
+        node = get_image_prompt_node(self.story_id, story_content_id, content)
+        if not image_prompt or node_is_dirty(node, exists=True):
+            prompt_context = self.prompt_context.render()
+            image_prompt = run_build_node(
+                node, lambda: create_image_prompt(story_content_id, content, self.characters_prompt, prompt_context)
+            )
+        self.prompt_context.add(image_prompt)
+        return image_prompt
+
+    def build_image(self, story_content_id, prompt_future):
+        node = BuildNode(self.story_id, story_content_id, "image", f"{self.story_path}/content-img-{story_content_id}.png", hash_inputs(prompt_future.result()))
+        if node_is_dirty(node, [node.path]):
+            run_build_node(node, lambda: create_content_image(story_content_id))
+
+    def build_audio(self, story_content_id, content):
+        node = get_audio_node(self.story_id, story_content_id, self.story_path, content)
+        if audio_is_dirty(self.story_id, story_content_id, self.story_path, content):
+            run_build_node(node, lambda: create_audio(story_content_id))
+
+    def build_final(self):
+        paths = [f"{self.story_path}/title.png"] + [get_clip_path(self.story_path, story_content_id) for story_content_id in self.story_content_ids]
+        node = BuildNode(self.story_id, None, "final", f"{self.story_path}/final.mp4", hash_inputs(*[hash_file(path) for path in paths]))
+        if node_is_dirty(node, [node.path]):
+            run_build_node(node, lambda: stitch_video(self.story_id))
+
+# The hash names the voice that made the file, the page voice or the narration voice
+def get_audio_node(story_id, story_content_id, story_path, content, voice_name=VOICE_NAME):
+    return BuildNode(story_id, story_content_id, "audio", f"{story_path}/content-{story_content_id}.mp3", hash_inputs(content, VOICE_LANGUAGE_CODE, voice_name, SPEAKING_RATE))
+
+# Narrated audio counts as built for the same page content
+def audio_is_dirty(story_id, story_content_id, story_path, content):
+    return all(
+        node_is_dirty(node, [node.path])
+        for node in (get_audio_node(story_id, story_content_id, story_path, content, voice_name) for voice_name in (VOICE_NAME, NARRATION_VOICE_NAME))
+    )
+
+def get_pages_node(story_id, story_path, story_text):
+    return BuildNode(story_id, None, "pages", f"{story_path}/story.txt", hash_inputs(story_text))
 
-    c.execute("SELECT id FROM story_content WHERE story_id = ?", (story_id,))
-    contents = c.fetchall()
+# Regenerate only the parts of a story whose inputs changed since they were last
+# built: story text -> pages -> image prompt -> image/audio -> page clip -> final video.
+# Every finished node is recorded, so a failed build resumes where it stopped.
+@story_stage("build")
+def build_story(story_id, publish=False):
+    logger.info(f'Building Story {story_id}')
 
-    for row in contents:
-        create_video_clip(row[0], create_videos=True)
+    story = get_story_manifest(story_id)
+
+    if not story:
+        logger.error(f"Story {story_id} not found")
+        exit(1)
 
+    story_path = story.story_path
+
+    # Pages are only split from the story text once, after that pages are edited
+    # directly in story_content
+    pages_node = get_pages_node(story_id, story_path, story.story)
+    if not story.pages:
+        def build_pages():
+            conn, c = get_db_connection()
+            insert_pages(c, story_id, story.story)
+            conn.commit()
+            conn.close()
+        run_build_node(pages_node, build_pages)
+        story = get_story_manifest(story_id)
+    elif node_is_dirty(pages_node, exists=True):
+        logger.warning("Story text changed after it was split into pages, edit story_content to change pages")
+        record_artifact(*pages_node)
+
+    # Upload what already exists while the rest renders
+    upload = start_publish(story_path) if publish else None
+
+    with Pipeline({"api": get_max_workers(), "encode": get_encode_workers()}) as pipeline:
+        build = StoryBuild(story_id, story_path, pipeline)
+        build.add_title([page.content for page in story.pages])
+        for page in story.pages:
+            build.add_page(page.id, page.content, page.image_prompt)
+        build.finish()
+        pipeline.wait()
+
+    if upload:
+        finish_publish(upload, story_path)
+
+    logger.info(f'Story {story_id} is up to date')
+
+# The storage helpers are imported on use so commands that never publish stay light
+def start_publish(story_path):
+    from google.cloud import publish_story
+    return publish_story(story_path, background=True)
+
+# Wait for the background upload, then upload anything rendered since it started
+def finish_publish(upload, story_path):
+    from google.cloud import publish_story
+    upload.result()
+    publish_story(story_path)
+
+@story_stage("publish")
+def publish_story_files(story_id):
+    conn, c = get_db_connection()
+    c.execute("SELECT story_path FROM story WHERE id = ?", (story_id,))
+    story = c.fetchone()
     conn.close()
 
+    if not story:
+        logger.error(f"Story {story_id} not found")
+        exit(1)
+
+    from google.cloud import publish_story
+    publish_story(story[0])
 
 # Generate video by stitching together images and audio
-def stitch_video(story_id, create_videos=False):
+@story_stage("stitch")
+def stitch_video(story_id, create_videos=False, profile="final"):
     logger.info('Stitching Video')
 
     # use ffmpeg to stitch together images and audio
-    conn, c = get_db_connection()
+    story = get_story_manifest(story_id)
 
-    # Get the title image
-    c.execute("SELECT title_image_path, story_path FROM story WHERE id = ?", (story_id,))
-    story = c.fetchone()
+    if create_videos:
+        create_video_clips(story_id, profile)
+
+    clips = [get_clip_path(story.story_path, page.id, profile) for page in story.pages]
 
-    # Get all the content for the story
-    c.execute("SELECT id, audio_path, image_path FROM story_content WHERE story_id = ?", (story_id,))
-    story_contents = c.fetchall()
+    pre_clip_path = f"{story.story_path}/{RENDER_PROFILES[profile]['pre']}"
+    final_clip_path = f"{story.story_path}/{RENDER_PROFILES[profile]['output']}"
 
-    clips = []
+    # Join the clips without re-encoding, then encode the final video once
+    concat_clips(clips, pre_clip_path, story.story_path)
+    render_final(story.title_image_path, pre_clip_path, "assets/lullaby.mp3", final_clip_path, profile)
 
-    for row in story_contents:
-        clips.append(create_video_clip(row[0], create_videos))
+def get_variant_audio_path(story_path, story_content_id, name):
+    return f"{story_path}/content-{story_content_id}-{name}.mp3"
 
-    pre_clip_path = f"{story[1]}/pre.mp4"
-    final_clip_path = f"{story[1]}/final.mp4"
+# A voice variant is rebuilt when its page, voice or translation changes
+def get_variant_audio_node(story_id, page, variant):
+    return BuildNode(
+        story_id, page.id, f"audio_{variant['name']}", get_variant_audio_path(page.story_path, page.id, variant["name"]),
+        hash_inputs(page.content, variant["language_code"], variant["voice"], variant["translate_to"], SPEAKING_RATE)
+    )
 
-    os.system(f"rm -f temp.txt")
-    clips_str = ""
-    for clip in clips:
-        clips_str += f"file {clip}\n"
-    with open("temp.txt", "w") as f:
-        f.write(clips_str)
-    os.system(f"ffmpeg -f concat -safe 0 -i temp.txt -c:v libx264 -c:a aac {pre_clip_path}")
+def get_story_voice_variants(story):
+    variants = get_voice_variants(get_config(story.config_path))
+    if variants is None:
+        exit(1)
+    if not variants:
+        logger.error("Add [[voices]] to the story's config to create voice variants")
+        exit(1)
+    return variants
 
-    title_image = ImageClip(story[0]).set_duration(3)
-    story_clip = VideoFileClip(pre_clip_path)
-    final_clip = concatenate_videoclips([title_image, story_clip, title_image])
-    background_audio = audio_loop.audio_loop(AudioFileClip("assets/lullaby.mp3"), duration=final_clip.duration).volumex(0.075)
-    final_audio = CompositeAudioClip([final_clip.audio, background_audio])
-    final_clip = final_clip.set_audio(final_audio)
-    final_clip.write_videofile(final_clip_path, codec="libx264", audio_codec="aac")
+def translate_page(story_content_id, content, language):
+    prompt = (
+        f"Translate the following page of a whimsical children's storybook into {language}."
+        "Keep the language simple and playful, suitable for children aged 1-3 years old."
+        "Respond with only the translation."
+        f"Page: ```{content}``` End Page"
+    )
+    text = generate_text(prompt)
+    if not text:
+        logger.error(f"Failed to translate content {story_content_id} to {language}")
+        exit(1)
+    return text.strip()
 
-    conn.close()
+@page_stage("variant_audio")
+def create_variant_audio(story_content_id, variant):
+    logger.info(f"Generating {variant['name']} Audio for Story Content")
+    page = get_page(story_content_id)
+    text = translate_page(story_content_id, page.content, variant["translate_to"]) if variant["translate_to"] else page.content
+
+    response = None
+    attempts = 0
+
+    while not response and attempts < 3:
+        if attempts:
+            note_retry()
+        attempts += 1
+        response = generate_audio(text, variant["language_code"], variant["voice"])
+
+    if not response:
+        logger.error(f"Failed to generate {variant['name']} audio for content {story_content_id}")
+        exit(1)
+
+    file_name = get_variant_audio_path(page.story_path, story_content_id, variant["name"])
+    with open(file_name, "wb") as out:
+        out.write(response)
+
+    upsert_audio_variants([(story_content_id, variant["name"], variant["language_code"], variant["voice"], text, file_name)])
+
+# Synthesize every out of date narration of every page, the default voice and
+# each [[voices]] variant, all at the same time
+@story_stage("variant_audios")
+def create_variant_audios(story_id):
+    logger.info('Creating Voice Variant Audio Files')
+
+    story = get_story_manifest(story_id)
+    variants = get_story_voice_variants(story)
+
+    jobs = []
+    for page in story.pages:
+        node = get_audio_node(story_id, page.id, story.story_path, page.content)
+        if audio_is_dirty(story_id, page.id, story.story_path, page.content):
+            jobs.append((node, functools.partial(create_audio, page.id)))
+        for variant in variants:
+            node = get_variant_audio_node(story_id, page, variant)
+            if node_is_dirty(node, [node.path]):
+                jobs.append((node, functools.partial(create_variant_audio, page.id, variant)))
+
+    run_concurrently(lambda job: run_build_node(*job), jobs)
+
+# Render one video with a narration track per voice. Each page is encoded once
+# as a silent still clip as long as its longest narration, and every narration
+# is padded to the same page lengths, so adding a voice adds an audio encode
+# rather than another video encode.
+@story_stage("stitch_variants")
+def stitch_variants(story_id, profile="final"):
+    logger.info('Stitching Voice Variants')
+
+    story = get_story_manifest(story_id)
+    variants = get_story_voice_variants(story)
+    variant_paths = get_audio_variants(story_id)
+    names = ["default"] + [variant["name"] for variant in variants]
+
+    page_audio_paths = []
+    for page in story.pages:
+        audio_paths = [page.audio_path] + [variant_paths.get((page.id, variant["name"])) for variant in variants]
+        if not all(audio_paths):
+            logger.error(f"Content {page.id} is missing narration, run --variants {story_id} to create it")
+            exit(1)
+        page_audio_paths.append((page, audio_paths))
+
+    durations = dict(run_concurrently(
+        lambda path: (path, probe_duration(path)), [path for _, audio_paths in page_audio_paths for path in audio_paths]
+    ))
+    pages = [
+        (page, audio_paths, get_page_duration([durations[path] for path in audio_paths]))
+        for page, audio_paths in page_audio_paths
+    ]
+
+    # Only encode still clips whose image or length changed
+    jobs = {}
+    for page, _, duration in pages:
+        image_path = get_encode_image_path(page.image_path, page.normalized_image_path)
+        still_path = get_still_path(story.story_path, page.id, profile)
+        node = BuildNode(story_id, page.id, f"{profile}_still", still_path, hash_inputs(hash_file(image_path), duration))
+        if node_is_dirty(node, [still_path]):
+            jobs[(image_path, duration, still_path, story_id, page.id, profile)] = node
+    run_in_pool(encode_still, list(jobs), lambda job: record_artifact(*jobs[job]))
+
+    # Each narration track only depends on its own audio files and the page lengths
+    def build_track(index):
+        track_pages = [(audio_paths[index], duration) for _, audio_paths, duration in pages]
+        track_path = get_track_path(story.story_path, names[index], profile)
+        node = BuildNode(
+            story_id, None, f"{profile}_track_{names[index]}", track_path,
+            hash_inputs(*[hash_inputs(hash_file(path), duration) for path, duration in track_pages])
+        )
+        if node_is_dirty(node, [track_path]):
+            run_build_node(node, lambda: build_narration_track(track_pages, track_path, profile))
+
+    run_concurrently(build_track, range(len(names)))
+    track_paths = [get_track_path(story.story_path, name, profile) for name in names]
+
+    pre_clip_path = f"{story.story_path}/{RENDER_PROFILES[profile]['variants_pre']}"
+    final_clip_path = f"{story.story_path}/{RENDER_PROFILES[profile]['variants_output']}"
+
+    concat_clips([get_still_path(story.story_path, page.id, profile) for page, _, _ in pages], pre_clip_path, story.story_path)
+    render_final_tracks(
+        story.title_image_path, pre_clip_path, list(zip(track_paths, names)), "assets/lullaby.mp3", final_clip_path, profile
+    )
+
+def get_hls_dir(story_path, profile="final"):
+    return f"{story_path}/{RENDER_PROFILES[profile]['hls']}"
+
+# Segment a clip into the HLS directory under a prefix, replacing the old
+# segments of that prefix, which may have been cut differently
+def segment_part(clip_path, hls_dir, prefix):
+    for name in os.listdir(hls_dir):
+        if name.startswith(f"{prefix}-") and name.endswith(".ts"):
+            os.remove(f"{hls_dir}/{name}")
+    segment_clip(clip_path, f"{hls_dir}/{prefix}.m3u8", f"{hls_dir}/{prefix}-%03d.ts")
+
+# Write a story as HLS: the title card, then each page, then the title card
+# again, with segments cut along page boundaries. Pages are segmented from
+# their clips by stream copy, and only pages whose clip changed are segmented
+# again, so after an edit only that page's segments and the playlists change
+# and --publish uploads just those. Background music is left out, as mixing it
+# in would tie every page to the length of the pages before it.
+@story_stage("hls")
+def create_hls(story_id, profile="final"):
+    logger.info('Creating HLS')
+
+    story = get_story_manifest(story_id)
+    if not story:
+        logger.error(f"Story {story_id} not found")
+        exit(1)
+
+    if not story.title_image_path:
+        logger.error(f"Story {story_id} has no title image, run --build {story_id} first")
+        exit(1)
+
+    # Only re-encodes the clips whose image or audio changed
+    create_video_clips(story_id, profile)
+
+    hls_dir = get_hls_dir(story.story_path, profile)
+    os.makedirs(hls_dir, exist_ok=True)
+
+    title_clip_path = f"{story.story_path}/{RENDER_PROFILES[profile]['title_clip']}"
+    title_node = BuildNode(story_id, None, f"{profile}_hls_title", f"{hls_dir}/title.m3u8", hash_inputs(hash_file(story.title_image_path)))
+    if node_is_dirty(title_node, [title_node.path]):
+        def build_title():
+            encode_title_clip(story.title_image_path, title_clip_path, profile)
+            segment_part(title_clip_path, hls_dir, "title")
+        run_build_node(title_node, build_title)
+
+    def build_page(page):
+        clip_path = get_clip_path(story.story_path, page.id, profile)
+        node = BuildNode(story_id, page.id, f"{profile}_hls", f"{hls_dir}/page-{page.id}.m3u8", hash_inputs(hash_file(clip_path)))
+        if node_is_dirty(node, [node.path]):
+            run_build_node(node, lambda: segment_part(clip_path, hls_dir, f"page-{page.id}"))
+
+    run_concurrently(build_page, story.pages)
+
+    title = read_media_playlist(f"{hls_dir}/title.m3u8")
+    parts = [title] + [read_media_playlist(f"{hls_dir}/page-{page.id}.m3u8") for page in story.pages] + [title]
+    chapters = [("Title", sum(duration for duration, _ in title))]
+    chapters += [(f"Page {number}", sum(duration for duration, _ in part)) for number, part in enumerate(parts[1:-1], 1)]
+    chapters.append(("The End", chapters[0][1]))
+
+    write_story_playlist(f"{hls_dir}/story.m3u8", parts)
+    write_chapters(f"{hls_dir}/chapters.vtt", chapters)
+    write_chapter_list(f"{hls_dir}/chapters.json", chapters)
+    write_master_playlist(f"{hls_dir}/index.m3u8", "story.m3u8", "chapters.json", get_peak_bandwidth(hls_dir, parts))
+
+    logger.info(f"Wrote {hls_dir}/index.m3u8")
+
+# Jobs a --serve process can run, by kind. Each takes the job's id argument and
+# the config file it was queued with, which only new stories need as every
+# other stage reads the config its story was written from.
+JOB_HANDLERS = {
+    "new": lambda arg, config_path: new_story(config_path=config_path),
+    "build": lambda arg, config_path: build_story(arg),
+    "update_image": lambda arg, config_path: (create_content_image(arg, cache=False), normalize_content_image(arg)),
+    "update_audio": lambda arg, config_path: create_audio(arg),
+    "update_audios": lambda arg, config_path: create_audios(arg),
+    "create_videos": lambda arg, config_path: create_video_clips(arg),
+    "create_video": lambda arg, config_path: create_video_clip(arg, create_videos=True),
+    "stitch": lambda arg, config_path: stitch_video(arg),
+    "publish": lambda arg, config_path: publish_story_files(arg),
+    "hls": lambda arg, config_path: create_hls(arg),
+    "variants": lambda arg, config_path: (create_variant_audios(arg), stitch_variants(arg)),
+}
+
+DEFAULT_MAX_JOBS = 2
+POLL_INTERVAL = 1
+
+def get_max_jobs():
+    return max(1, int(os.getenv('MAX_JOBS', DEFAULT_MAX_JOBS)))
+
+def run_job(job, worker):
+    job_id, kind, arg, config_path = job
+    logger.info(f"Running job {job_id}: {kind} {arg if arg is not None else config_path or ''}")
+    try:
+        JOB_HANDLERS[kind](arg, config_path)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        # Stages exit on failure, which must only fail the job and not the server
+        logger.error(f"Job {job_id} failed: {e!r}")
+        reset_db_connection()
+        finish_job(job_id, repr(e), worker)
+        return
+    logger.info(f"Job {job_id} finished")
+    finish_job(job_id, worker=worker)
+
+def warm_session():
+    try:
+        get_session().warm()
+    except Exception as e:
+        logger.error(f"Failed to warm provider clients: {e}")
+
+# Run queued jobs until interrupted. The provider clients and the polling db
+# connection stay open between jobs, so no job pays the cold start cost. The
+# leases of running jobs are renewed from this loop, so if the process dies
+# another worker picks its jobs up once the leases run out.
+def serve_jobs(max_jobs):
+    worker = get_worker_id()
+    lease_seconds = get_lease_seconds()
+    logger.info(f"Worker {worker} serving jobs, running up to {max_jobs} at a time")
+    threading.Thread(target=warm_session, daemon=True).start()
+
+    conn, _ = get_db_connection()
+    executor = ThreadPoolExecutor(max_workers=max_jobs)
+    running = {}
+    finished = 0
+    started = time.monotonic()
+    renewed = started
+    try:
+        while True:
+            for future in [future for future in running if future.done()]:
+                del running[future]
+                finished += 1
+                hours = (time.monotonic() - started) / 3600
+                logger.info(f"Worker {worker} has finished {finished} jobs, {finished / hours:.1f} per hour")
+            if time.monotonic() - renewed > lease_seconds / 3:
+                renew_leases(conn, worker, list(running.values()), lease_seconds)
+                renewed = time.monotonic()
+            job = claim_job(conn, worker, lease_seconds) if len(running) < max_jobs else None
+            if job:
+                running[executor.submit(run_job, job, worker)] = job[0]
+                continue
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("Stopping, waiting for running jobs to finish")
+    finally:
+        executor.shutdown(wait=True)
+        conn.close()
+
+# Start several serve processes on this machine. Each claims jobs on its own, the
+# same as workers started on other hosts that share the database and stories.
+def serve_workers(workers, max_jobs):
+    if workers <= 1:
+        serve_jobs(max_jobs)
+        return
+    processes = [multiprocessing.Process(target=serve_jobs, args=(max_jobs,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Every worker gets the interrupt too and stops once its jobs finish
+        for process in processes:
+            process.join()
+
+def print_jobs():
+    for job_id, kind, arg, status, error, created_at, started_at, finished_at, worker in list_jobs():
+        line = f"{job_id}: {kind} {arg if arg is not None else ''} {status}, queued {created_at}"
+        if worker:
+            line += f", on {worker}"
+        if finished_at:
+            line += f", finished {finished_at}"
+        if error:
+            line += f", {error}"
+        print(line)
+    for batch, total, done, failed, running, pending, seconds in batch_throughput():
+        line = f"Batch {batch}: {done} of {total} done, {failed} failed, {running} running, {pending} pending"
+        if done and seconds:
+            line += f", {done / (seconds / 3600):.1f} stories per hour"
+        print(line)
+    print(f"Job kinds: {', '.join(JOB_HANDLERS)}")
 
 if __name__ == '__main__':
     main()
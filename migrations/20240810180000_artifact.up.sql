@@ -0,0 +1,12 @@
+-- Add up migration script here for sqlite
+CREATE TABLE artifact (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  story_id INTEGER NOT NULL,
+  story_content_id INTEGER,
+  kind TEXT NOT NULL,
+  path TEXT NOT NULL UNIQUE,
+  input_hash TEXT NOT NULL,
+  updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (story_id) REFERENCES story(id),
+  FOREIGN KEY (story_content_id) REFERENCES story_content(id)
+);
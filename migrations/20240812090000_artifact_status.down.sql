@@ -0,0 +1,3 @@
+-- Add down migration script here
+
+ALTER TABLE artifact DROP COLUMN status;
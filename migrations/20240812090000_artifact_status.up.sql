@@ -0,0 +1,2 @@
+-- Add up migration script here for sqlite
+ALTER TABLE artifact ADD COLUMN status TEXT NOT NULL DEFAULT 'done';
@@ -0,0 +1,15 @@
+-- Add up migration script here for sqlite
+CREATE TABLE metric (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  story_id INTEGER,
+  story_content_id INTEGER,
+  stage TEXT NOT NULL,
+  duration REAL NOT NULL,
+  retries INTEGER NOT NULL DEFAULT 0,
+  bytes_in INTEGER,
+  bytes_out INTEGER,
+  outcome TEXT NOT NULL,
+  created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX metric_story_id ON metric (story_id);
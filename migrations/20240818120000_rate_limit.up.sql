@@ -0,0 +1,8 @@
+-- Add up migration script here for sqlite
+CREATE TABLE rate_limit (
+  provider TEXT PRIMARY KEY,
+  tokens REAL NOT NULL,
+  updated_at REAL NOT NULL,
+  blocked_until REAL NOT NULL DEFAULT 0,
+  failures INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,3 @@
+-- Add down migration script here
+
+ALTER TABLE story_content DROP COLUMN normalized_image_path;
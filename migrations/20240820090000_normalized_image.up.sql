@@ -0,0 +1,2 @@
+-- Add up migration script here for sqlite
+ALTER TABLE story_content ADD COLUMN normalized_image_path TEXT;
@@ -0,0 +1,13 @@
+-- Add up migration script here for sqlite
+CREATE TABLE job (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  arg INTEGER,
+  status TEXT NOT NULL DEFAULT 'pending',
+  error TEXT,
+  created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+  started_at DATETIME,
+  finished_at DATETIME
+);
+
+CREATE INDEX job_status ON job (status, id);
@@ -0,0 +1,11 @@
+-- Add down migration script here
+
+DROP INDEX job_batch;
+
+ALTER TABLE job DROP COLUMN attempts;
+ALTER TABLE job DROP COLUMN lease_expires_at;
+ALTER TABLE job DROP COLUMN worker;
+ALTER TABLE job DROP COLUMN batch;
+ALTER TABLE job DROP COLUMN config_path;
+
+ALTER TABLE story DROP COLUMN config_path;
@@ -0,0 +1,10 @@
+-- Add up migration script here for sqlite
+ALTER TABLE story ADD COLUMN config_path TEXT;
+
+ALTER TABLE job ADD COLUMN config_path TEXT;
+ALTER TABLE job ADD COLUMN batch TEXT;
+ALTER TABLE job ADD COLUMN worker TEXT;
+ALTER TABLE job ADD COLUMN lease_expires_at DATETIME;
+ALTER TABLE job ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX job_batch ON job (batch);
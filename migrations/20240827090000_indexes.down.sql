@@ -0,0 +1,4 @@
+-- Add down migration script here
+
+DROP INDEX artifact_story_id;
+DROP INDEX story_content_story_id;
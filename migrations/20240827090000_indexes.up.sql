@@ -0,0 +1,3 @@
+-- Add up migration script here for sqlite
+CREATE INDEX story_content_story_id ON story_content (story_id);
+CREATE INDEX artifact_story_id ON artifact (story_id);
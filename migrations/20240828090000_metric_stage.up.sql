@@ -0,0 +1,2 @@
+-- Add up migration script here for sqlite
+CREATE INDEX metric_stage ON metric (stage, id);
@@ -0,0 +1,13 @@
+-- Add up migration script here for sqlite
+CREATE TABLE audio_variant (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  story_content_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  language_code TEXT NOT NULL,
+  voice TEXT NOT NULL,
+  text TEXT NOT NULL,
+  audio_path TEXT NOT NULL,
+  updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (story_content_id, name),
+  FOREIGN KEY (story_content_id) REFERENCES story_content(id)
+);
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_URL = "sqlite://cache.db"
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Persistent, content addressed cache for provider responses. Entries are keyed
+# by a hash of the normalized prompt and every parameter that affects the output,
+# and the least recently used entries are evicted once the size cap is reached.
+class ResponseCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._setup()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _setup(self):
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_entry_last_access ON cache_entry (last_access)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_stats ("
+            "kind TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0, "
+            "bytes_saved INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.commit()
+        conn.close()
+
+    def get(self, kind, key):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value FROM cache_entry WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE cache_entry SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._count(conn, kind, hit=True, size=len(row[0]))
+            else:
+                self._count(conn, kind, hit=False, size=0)
+            conn.commit()
+            conn.close()
+        if row:
+            logger.info(f"Cache hit for {kind}")
+            return row[0]
+        return None
+
+    def put(self, kind, key, value):
+        if value is None:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entry (key, kind, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, kind, value, len(value), time.time())
+            )
+            self._evict(conn)
+            conn.commit()
+            conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        rows = conn.execute("SELECT kind, hits, misses, bytes_saved FROM cache_stats ORDER BY kind").fetchall()
+        size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entry").fetchone()
+        conn.close()
+        return rows, size
+
+    def _count(self, conn, kind, hit, size):
+        conn.execute("INSERT OR IGNORE INTO cache_stats (kind) VALUES (?)", (kind,))
+        if hit:
+            conn.execute("UPDATE cache_stats SET hits = hits + 1, bytes_saved = bytes_saved + ? WHERE kind = ?", (size, kind))
+        else:
+            conn.execute("UPDATE cache_stats SET misses = misses + 1 WHERE kind = ?", (kind,))
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entry").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM cache_entry ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+            total -= size
+        logger.info(f"Evicted cache entries, cache is now {total} bytes")
+
+def normalize_prompt(prompt):
+    if isinstance(prompt, str):
+        return " ".join(prompt.split())
+    if isinstance(prompt, (list, tuple)):
+        return [normalize_prompt(part) for part in prompt]
+    return prompt
+
+def cache_key(kind, prompt, **params):
+    payload = json.dumps(
+        {"kind": kind, "prompt": normalize_prompt(prompt), "params": params},
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            path = os.getenv('CACHE_URL', DEFAULT_CACHE_URL)
+            if path.startswith("sqlite://"):
+                path = path[9:]
+            max_bytes = int(os.getenv('CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+            _cache = ResponseCache(path, max_bytes)
+        return _cache
+
+def cache_enabled():
+    return os.getenv('CACHE_DISABLED', '').lower() not in ('1', 'true', 'yes')
@@ -0,0 +1,114 @@
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed, wait
+import contextvars
+import logging
+import os
+import threading
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+
+def get_max_workers():
+    max_workers = os.getenv('MAX_WORKERS')
+    if not max_workers:
+        return DEFAULT_MAX_WORKERS
+    try:
+        return max(1, int(max_workers))
+    except ValueError:
+        logger.error(f"Invalid MAX_WORKERS value: {max_workers}, using {DEFAULT_MAX_WORKERS}")
+        return DEFAULT_MAX_WORKERS
+
+# Wait for the futures in completion order, cancelling the rest if one fails
+def wait_all(futures):
+    results = []
+    try:
+        for future in as_completed(futures):
+            results.append(future.result())
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return results
+
+# Submit fn to an executor in a copy of the caller's context, so context
+# variables such as the metrics story and page follow the work onto the worker
+def submit_in_context(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Run fn for every item using a bounded pool of worker threads
+def run_concurrently(fn, items, max_workers=None):
+    with ThreadPoolExecutor(max_workers=max_workers or get_max_workers()) as executor:
+        futures = [submit_in_context(executor, fn, item) for item in items]
+        return wait_all(futures)
+
+def _copy_outcome(source, target):
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+# Schedules tasks across named thread pools as soon as the tasks they depend on
+# finish, so independent work from different stages overlaps. A task whose
+# dependency fails fails with the same error without running.
+class Pipeline:
+    def __init__(self, pools):
+        self._executors = {name: ThreadPoolExecutor(max_workers=size) for name, size in pools.items()}
+        self._lock = threading.Lock()
+        self.futures = []
+
+    def submit(self, fn, *args, after=(), pool=None):
+        executor = self._executors[pool] if pool else next(iter(self._executors.values()))
+        future = Future()
+        deps = [dep for dep in after if dep is not None]
+        remaining = [len(deps)]
+        # Tasks run in the context they were submitted from, not the one of
+        # the dependency that happened to finish last
+        context = contextvars.copy_context()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                executor.submit(context.run, fn, *args).add_done_callback(lambda done: _copy_outcome(done, future))
+            except BaseException as e:
+                future.set_exception(e)
+
+        def on_dep_done(dep):
+            error = CancelledError() if dep.cancelled() else dep.exception()
+            with self._lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] = 0 if error is not None else remaining[0] - 1
+                ready = remaining[0] == 0
+            if not ready:
+                return
+            if error is None:
+                start()
+            elif future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+        with self._lock:
+            self.futures.append(future)
+        if not deps:
+            start()
+        for dep in deps:
+            dep.add_done_callback(on_dep_done)
+        return future
+
+    # Wait for every task, then raise the first error if any task failed
+    def wait(self):
+        wait(self.futures)
+        for future in self.futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def shutdown(self, cancel_futures=False):
+        for executor in self._executors.values():
+            executor.shutdown(wait=True, cancel_futures=cancel_futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown(cancel_futures=exc_type is not None)
@@ -0,0 +1,49 @@
+from collections import deque
+import logging
+import os
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROMPT_WINDOW = 3
+DEFAULT_SUMMARY_INTERVAL = 5
+
+def get_prompt_window():
+    return int(os.getenv('PROMPT_WINDOW', DEFAULT_PROMPT_WINDOW))
+
+def get_summary_interval():
+    return int(os.getenv('SUMMARY_INTERVAL', DEFAULT_SUMMARY_INTERVAL))
+
+# Rough token count used to log prompt sizes without a round trip to the model
+def estimate_tokens(text):
+    return len(str(text)) // 4
+
+# Bounded context for writing a page's image prompt: the last few image prompts
+# verbatim plus a compact style and character summary that is updated every few
+# pages, so the prompt stays the same size however long the story is. The
+# summary is only brought up to date when a prompt is about to be written, so
+# rebuilding a story whose prompts are all current makes no summary calls.
+class PromptContext:
+    def __init__(self, summarize, window=None, summary_interval=None):
+        self.summarize = summarize
+        self.recent = deque(maxlen=window or get_prompt_window())
+        self.summary_interval = summary_interval or get_summary_interval()
+        self.summary = ""
+        self._unsummarized = []
+
+    def add(self, image_prompt):
+        self.recent.append(image_prompt)
+        self._unsummarized.append(image_prompt)
+
+    def update_summary(self):
+        if len(self._unsummarized) < self.summary_interval:
+            return
+        summary = self.summarize(self.summary, self._unsummarized)
+        if summary:
+            self.summary = summary
+            self._unsummarized = []
+
+    def render(self):
+        self.update_summary()
+        return (
+            f"Style and Character Summary: ```{self.summary}``` End Summary\n"
+            f"Previous Image Prompts: ```{list(self.recent)}``` End Previous Image Prompts\n"
+        )
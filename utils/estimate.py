@@ -0,0 +1,170 @@
+import re
+import logging
+from database.utils import get_db_connection
+from utils.context import estimate_tokens, get_prompt_window, get_summary_interval
+from utils.metrics import flush, percentile
+from utils.ratelimit import get_rate
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = 200
+
+# Seconds per call used until a stage has recorded metrics of its own
+DEFAULT_LATENCIES = {
+    "gemini": 8.0,
+    "gemini_json": 60.0,
+    "gemini_stream": 45.0,
+    "tts": 3.0,
+    "tts_narration": 20.0,
+    "imagen": 10.0,
+    "ffmpeg_cut": 0.2,
+    "ffmpeg_normalize": 0.5,
+    "ffmpeg_clip": 4.0,
+    "ffmpeg_concat": 1.0,
+    "ffmpeg_final": 30.0,
+}
+
+# Sizes used until there are stories in the db to measure
+DEFAULT_PAGE_CHARS = 200
+DEFAULT_IMAGE_PROMPT_CHARS = 512
+SUMMARY_TOKENS = 160
+# The fixed instructions of the image prompt, title prompt and summary requests
+INSTRUCTION_TOKENS = 250
+
+# Median seconds per successful call of a stage over its recent calls
+def get_latency(c, stage):
+    c.execute(
+        "SELECT duration FROM metric WHERE stage = ? AND outcome = 'ok' ORDER BY id DESC LIMIT ?",
+        (stage, HISTORY_SIZE)
+    )
+    durations = [row[0] for row in c.fetchall()]
+    return percentile(durations, 0.5) if durations else DEFAULT_LATENCIES[stage]
+
+def get_latencies():
+    flush()
+    conn, c = get_db_connection()
+    latencies = {stage: get_latency(c, stage) for stage in DEFAULT_LATENCIES}
+    conn.close()
+    return latencies
+
+# Pages per story and the average page and image prompt length of earlier stories
+def get_page_history():
+    conn, c = get_db_connection()
+    c.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT story_id), AVG(LENGTH(content)), AVG(LENGTH(image_prompt)) FROM story_content"
+    )
+    pages, stories, page_chars, image_prompt_chars = c.fetchone()
+    conn.close()
+    return (
+        pages / stories if stories else None,
+        page_chars or DEFAULT_PAGE_CHARS,
+        image_prompt_chars or DEFAULT_IMAGE_PROMPT_CHARS
+    )
+
+# The midpoint of every "5 - 8 scenes" range in the outline
+def count_outline_scenes(outline):
+    ranges = re.findall(r"(\d+)\s*-\s*(\d+)\s+scenes", outline)
+    return round(sum((int(low) + int(high)) / 2 for low, high in ranges))
+
+# Seconds a provider needs to make calls within its requests per minute quota
+def get_quota_seconds(provider, calls):
+    return calls / get_rate(provider) * 60
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+# Estimate the calls, tokens and time of --new from its prompts and outline,
+# the size of earlier stories and the recorded latency of every stage
+def estimate_new_story(prompts, outline, structured, max_workers, encode_workers):
+    latency = get_latencies()
+    pages_per_story, page_chars, image_prompt_chars = get_page_history()
+    pages = round(pages_per_story or count_outline_scenes(outline) or 10)
+    page_tokens = page_chars / 4
+    image_prompt_tokens = image_prompt_chars / 4
+    window = get_prompt_window()
+    interval = get_summary_interval()
+    characters_tokens = estimate_tokens(prompts[1])
+
+    story_in = estimate_tokens(" ".join(prompts) + outline)
+    story_out = pages * (page_tokens + (image_prompt_tokens if structured else 0))
+
+    # Each image prompt carries the last few prompts and, after the first
+    # summary, the style summary. The context stops growing once both are full.
+    image_prompt_ins = []
+    for page in range(0 if structured else pages):
+        summary = SUMMARY_TOKENS if page >= interval else 0
+        image_prompt_ins.append(
+            INSTRUCTION_TOKENS + characters_tokens + min(page, window) * image_prompt_tokens + summary + page_tokens
+        )
+    summaries = 0 if structured else pages // interval
+    summary_in = INSTRUCTION_TOKENS + SUMMARY_TOKENS + interval * image_prompt_tokens
+    title_in = INSTRUCTION_TOKENS + estimate_tokens(" ".join(prompts[1:])) + pages * page_tokens
+
+    gemini_calls = 1 + len(image_prompt_ins) + summaries + 1
+    gemini_in = story_in + sum(image_prompt_ins) + summaries * summary_in + title_in
+    gemini_out = story_out + (len(image_prompt_ins) + 1) * image_prompt_tokens + summaries * SUMMARY_TOKENS
+    imagen_calls = pages + 1
+    tts_chars = pages * page_chars
+
+    # A whole story takes about as long to write as a streamed one
+    story_seconds = latency["gemini_json"] if structured else latency["gemini_stream"]
+    prompt_seconds = (len(image_prompt_ins) + summaries) * latency["gemini"]
+    encode_seconds = pages * (latency["ffmpeg_normalize"] + latency["ffmpeg_clip"])
+    api_seconds = imagen_calls * latency["imagen"] + pages * latency["tts"] + latency["gemini"]
+    finish_seconds = latency["ffmpeg_concat"] + latency["ffmpeg_final"]
+
+    # Image prompts are written in order, while images, audio and clips share
+    # their pools. The last page still needs its image and clip after its prompt.
+    build_seconds = max(
+        prompt_seconds + latency["imagen"] + latency["ffmpeg_normalize"] + latency["ffmpeg_clip"],
+        api_seconds / max_workers,
+        encode_seconds / encode_workers,
+        get_quota_seconds("gemini", gemini_calls),
+        get_quota_seconds("imagen", imagen_calls),
+        get_quota_seconds("tts", pages),
+    )
+    wall_seconds = story_seconds + build_seconds + finish_seconds
+
+    lines = [
+        f"About {pages} pages" + ("" if pages_per_story else " from the outline"),
+        "",
+        f"Gemini: {gemini_calls} calls, ~{round(gemini_in)} tokens in, ~{round(gemini_out)} tokens out",
+        f"  story: ~{round(story_in)} tokens in, ~{round(story_out)} tokens out",
+    ]
+    if image_prompt_ins:
+        lines.append(
+            f"  image prompts: {len(image_prompt_ins)} calls, ~{round(image_prompt_ins[0])} tokens in for the first page "
+            f"growing to ~{round(max(image_prompt_ins))}"
+        )
+    if summaries:
+        lines.append(f"  style summaries: {summaries} calls, ~{round(summary_in)} tokens in each")
+    lines += [
+        f"  title prompt: ~{round(title_in)} tokens in",
+        f"Text to Speech: {pages} calls, ~{round(tts_chars)} characters",
+        f"Imagen: {imagen_calls} calls",
+        f"ffmpeg: ~{format_seconds(encode_seconds + finish_seconds)} of encoding",
+        "",
+        f"Projected time with {max_workers} api and {encode_workers} encode workers: ~{format_seconds(wall_seconds)}",
+    ]
+    return lines
+
+# Estimate --update-audios for the pages of a story. narration_groups is the
+# number of requests --batch-tts would make, or None for one request per page.
+def estimate_audios(contents, max_workers, narration_groups=None):
+    latency = get_latencies()
+    chars = sum(len(content) for content in contents)
+
+    if narration_groups is None:
+        calls = len(contents)
+        seconds = max(calls * latency["tts"] / max_workers, get_quota_seconds("tts", calls))
+    else:
+        calls = narration_groups
+        seconds = max(
+            (calls * latency["tts_narration"] + len(contents) * latency["ffmpeg_cut"]) / max_workers,
+            get_quota_seconds("tts", calls)
+        )
+
+    return [
+        f"Text to Speech: {calls} calls, {chars} characters for {len(contents)} pages",
+        f"Projected time with {max_workers} workers: ~{format_seconds(seconds)}",
+    ]
@@ -0,0 +1,20 @@
+import hashlib
+import os
+
+# Hash a file in chunks so large images and audio are never fully loaded
+def hash_file(path, chunk_size=1024 * 1024):
+    if not path or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Combine the hashes of several inputs (file contents or plain values) into one
+def hash_inputs(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
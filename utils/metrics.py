@@ -0,0 +1,208 @@
+import atexit
+import contextvars
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from database.utils import get_db_path
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 100
+
+_context = contextvars.ContextVar("metrics_context", default={})
+_measurement = contextvars.ContextVar("metrics_measurement", default=None)
+_buffer = []
+_buffer_lock = threading.Lock()
+
+class Measurement:
+    def __init__(self, stage, bytes_in=None):
+        self.stage = stage
+        self.retries = 0
+        self.bytes_in = bytes_in
+        self.bytes_out = None
+        self.outcome = "ok"
+
+# Attach a story and page to every measurement made inside the block
+@contextmanager
+def metrics_context(story_id=None, story_content_id=None):
+    context = dict(_context.get())
+    if story_id is not None:
+        context["story_id"] = story_id
+    if story_content_id is not None:
+        context["story_content_id"] = story_content_id
+    token = _context.set(context)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+# Time the block and record its duration, retries, bytes and outcome
+@contextmanager
+def measure(stage, bytes_in=None):
+    measurement = Measurement(stage, bytes_in)
+    token = _measurement.set(measurement)
+    start = time.perf_counter()
+    try:
+        yield measurement
+    except BaseException:
+        measurement.outcome = "error"
+        raise
+    finally:
+        _measurement.reset(token)
+        record(measurement, time.perf_counter() - start)
+
+# Count a retry against the innermost measurement
+def note_retry():
+    measurement = _measurement.get()
+    if measurement:
+        measurement.retries += 1
+
+# Set the outcome of the innermost measurement, such as cache_hit
+def set_outcome(outcome):
+    measurement = _measurement.get()
+    if measurement:
+        measurement.outcome = outcome
+
+def payload_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, tuple) and value:
+        return payload_size(value[0])
+    image_bytes = getattr(value, "_image_bytes", None)
+    if image_bytes is not None:
+        return len(image_bytes)
+    return len(str(value).encode("utf-8"))
+
+# Measure a provider call whose first argument is the prompt. A None result
+# is recorded as a failed call.
+def provider_call(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(prompt, *args, **kwargs):
+            with measure(stage, bytes_in=payload_size(prompt)) as measurement:
+                result = fn(prompt, *args, **kwargs)
+                if result is None:
+                    measurement.outcome = "failed"
+                else:
+                    measurement.bytes_out = payload_size(result)
+                return result
+        return wrapper
+    return decorator
+
+def _stage(stage, key):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(entity_id, *args, **kwargs):
+            with metrics_context(**{key: entity_id}), measure(stage):
+                return fn(entity_id, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Measure a function whose first argument is a story id
+def story_stage(stage):
+    return _stage(stage, "story_id")
+
+# Measure a function whose first argument is a story_content id
+def page_stage(stage):
+    return _stage(stage, "story_content_id")
+
+def record(measurement, duration):
+    context = _context.get()
+    row = (
+        context.get("story_id"), context.get("story_content_id"), measurement.stage, duration,
+        measurement.retries, measurement.bytes_in, measurement.bytes_out, measurement.outcome
+    )
+    with _buffer_lock:
+        _buffer.append(row)
+        full = len(_buffer) >= FLUSH_SIZE
+    if full:
+        flush()
+
+# Write buffered measurements in one transaction. Pages recorded without a
+# story id are matched to their story as they are inserted.
+def flush():
+    with _buffer_lock:
+        rows = list(_buffer)
+        _buffer.clear()
+    if not rows:
+        return
+    try:
+        conn = sqlite3.connect(get_db_path(), timeout=30)
+        conn.executemany(
+            "INSERT INTO metric (story_id, story_content_id, stage, duration, retries, bytes_in, bytes_out, outcome) "
+            "VALUES (COALESCE(?1, (SELECT story_id FROM story_content WHERE id = ?2)), ?2, ?3, ?4, ?5, ?6, ?7, ?8)",
+            rows
+        )
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to write metrics: {e}")
+
+atexit.register(flush)
+
+# A forked child starts with a copy of the parent's unflushed measurements,
+# which the parent writes itself, and of a lock another thread may have held
+def _reset_after_fork():
+    global _buffer_lock
+    _buffer_lock = threading.Lock()
+    _buffer.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+# Cursor that records every statement as a db round trip
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with measure("db"):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with measure("db"):
+            return super().executemany(sql, seq_of_parameters)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+# Build the --profile report for a story
+def profile_report(story_id, slowest=5):
+    flush()
+    conn = sqlite3.connect(get_db_path(), timeout=30)
+    rows = conn.execute(
+        "SELECT stage, duration, retries, outcome FROM metric WHERE story_id = ?", (story_id,)
+    ).fetchall()
+    pages = conn.execute(
+        "SELECT story_content_id, SUM(duration) AS total FROM metric "
+        "WHERE story_id = ? AND story_content_id IS NOT NULL AND stage != 'db' "
+        "GROUP BY story_content_id ORDER BY total DESC LIMIT ?",
+        (story_id, slowest)
+    ).fetchall()
+    conn.close()
+
+    if not rows:
+        return [f"No metrics recorded for story {story_id}"]
+
+    stages = {}
+    for stage, duration, retries, outcome in rows:
+        stages.setdefault(stage, []).append((duration, retries, outcome))
+
+    lines = [f"{'stage':<20} {'calls':>6} {'total':>9} {'p50':>8} {'p95':>8} {'retries':>8} {'failed':>7}"]
+    for stage, measurements in sorted(stages.items(), key=lambda item: -sum(m[0] for m in item[1])):
+        durations = [m[0] for m in measurements]
+        lines.append(
+            f"{stage:<20} {len(measurements):>6} {sum(durations):>8.2f}s {percentile(durations, 0.5):>7.2f}s "
+            f"{percentile(durations, 0.95):>7.2f}s {sum(m[1] for m in measurements):>8} "
+            f"{sum(1 for m in measurements if m[2] not in ('ok', 'cache_hit')):>7}"
+        )
+    lines.append("")
+    lines.append("Slowest pages")
+    for story_content_id, total in pages:
+        lines.append(f"  story_content {story_content_id}: {total:.2f}s")
+    return lines
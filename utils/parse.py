@@ -1,4 +1,6 @@
 import toml
+import re
+import threading
 import logging
 import os
 logger = logging.getLogger(__name__)
@@ -14,8 +16,56 @@ def parse_toml_file(file_path):
         logger.error(f"Error parsing toml file: {e}")
         return None
 
-def get_config():
-    return parse_toml_file("config.toml")
+DEFAULT_CONFIG_PATH = "config.toml"
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+# Parse each config file once per process. A file that changed since it was
+# parsed, such as while --serve is running, is parsed again.
+def get_config(config_path=None):
+    path = config_path or DEFAULT_CONFIG_PATH
+    version = get_config_version(path)
+    with _configs_lock:
+        cached = _configs.get(path)
+    if cached and version is not None and cached[0] == version:
+        return cached[1]
+    config = parse_toml_file(path)
+    if config is not None and version is not None:
+        with _configs_lock:
+            _configs[path] = (version, config)
+    return config
+
+# Identifies the contents of a config file without reading it, or None if it is missing
+def get_config_version(config_path=None):
+    try:
+        stat = os.stat(config_path or DEFAULT_CONFIG_PATH)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Read the [[voices]] narration variants of a config. Each needs a name, a
+# language_code and a voice, and may name a language to translate the story to.
+def get_voice_variants(config):
+    variants = []
+    for voice in (config or {}).get("voices", []):
+        if not isinstance(voice, dict) or not all(voice.get(key) for key in ("name", "language_code", "voice")):
+            logger.error(f"Voice is missing name, language_code or voice: {voice}")
+            return None
+        if not re.fullmatch(r"[\w-]+", voice["name"]) or voice["name"] == "default":
+            logger.error(f"Voice name must use letters, numbers, - and _ and can not be default: {voice['name']}")
+            return None
+        variants.append({
+            "name": voice["name"],
+            "language_code": voice["language_code"],
+            "voice": voice["voice"],
+            "translate_to": voice.get("translate_to"),
+        })
+    names = [variant["name"] for variant in variants]
+    if len(set(names)) != len(names):
+        logger.error(f"Voice names must be unique: {names}")
+        return None
+    return variants
 
 def check_env_vars():
     env_vars = [
@@ -28,3 +78,45 @@ def check_env_vars():
             logger.error(f"Environment variable not set: {var}")
             return False
     return True
+
+# Read the pages of a structured story response into (content, image_prompt) pairs
+def parse_structured_story(response):
+    if not isinstance(response, dict) or not isinstance(response.get("pages"), list):
+        logger.error("Structured story is missing a list of pages")
+        return None
+    pages = []
+    for page in response["pages"]:
+        if not isinstance(page, dict):
+            continue
+        content = page.get("content")
+        image_prompt = page.get("image_prompt")
+        if not content or not image_prompt:
+            logger.error(f"Structured story page is missing content or image_prompt: {page}")
+            return None
+        pages.append((content.strip(), image_prompt.strip()))
+    if not pages:
+        logger.error("Structured story has no pages")
+        return None
+    return pages
+
+# Split streamed story text into pages on [PAGE] as the chunks arrive
+class PageSplitter:
+    MARKER = "[PAGE]"
+
+    def __init__(self):
+        self.text = ""
+        self._buffer = ""
+
+    # Add a chunk and return the pages it completed
+    def feed(self, chunk):
+        self.text += chunk
+        self._buffer += chunk
+        pages = self._buffer.split(self.MARKER)
+        self._buffer = pages.pop()
+        return [page for page in pages if page.strip()]
+
+    # Return the last page once the stream has ended
+    def finish(self):
+        page = self._buffer
+        self._buffer = ""
+        return [page] if page.strip() else []
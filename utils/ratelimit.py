@@ -0,0 +1,121 @@
+import logging
+import os
+import random
+import sqlite3
+import time
+from database.utils import get_db_path
+from utils.metrics import note_retry
+logger = logging.getLogger(__name__)
+
+# Requests per minute allowed for each provider, overridable with <PROVIDER>_RPM
+DEFAULT_RATES = {
+    "gemini": 60,
+    "tts": 300,
+    "imagen": 30,
+}
+MAX_ATTEMPTS = 6
+BASE_BACKOFF = 2
+MAX_BACKOFF = 120
+
+RATE_LIMITED_ERRORS = ("ResourceExhausted", "TooManyRequests")
+TRANSIENT_ERRORS = RATE_LIMITED_ERRORS + ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded")
+
+def get_rate(provider):
+    rpm = os.getenv(f"{provider.upper()}_RPM")
+    return float(rpm) if rpm else float(DEFAULT_RATES[provider])
+
+def is_rate_limited(error):
+    return type(error).__name__ in RATE_LIMITED_ERRORS or getattr(error, "code", None) == 429
+
+def is_transient(error):
+    return type(error).__name__ in TRANSIENT_ERRORS or is_rate_limited(error)
+
+# Token bucket per provider, kept in sqlite so every olliepie process on the
+# host shares one quota. A rate limited response blocks the provider for every
+# process until the backoff has passed.
+class RateLimiter:
+    def __init__(self, provider):
+        self.provider = provider
+        self.rate = get_rate(provider) / 60
+        self.burst = max(1.0, get_rate(provider) / 10)
+        self.failures = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(get_db_path(), timeout=30, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT tokens, updated_at, blocked_until, failures FROM rate_limit WHERE provider = ?", (self.provider,)
+        ).fetchone()
+        if not row:
+            row = (self.burst, time.time(), 0.0, 0)
+            conn.execute(
+                "INSERT INTO rate_limit (provider, tokens, updated_at, blocked_until, failures) VALUES (?, ?, ?, ?, ?)",
+                (self.provider,) + row
+            )
+        return conn, row
+
+    # Wait until a request may be sent, then take a token
+    def acquire(self):
+        while True:
+            conn, (tokens, updated_at, blocked_until, failures) = self._connect()
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if now < blocked_until:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute("UPDATE rate_limit SET tokens = ?, updated_at = ? WHERE provider = ?", (tokens, now, self.provider))
+            conn.execute("COMMIT")
+            conn.close()
+            self.failures = failures
+            if not wait:
+                return
+            time.sleep(wait + random.uniform(0, 0.1))
+
+    # Back off every process with exponential backoff and full jitter
+    def rate_limited(self):
+        conn, (tokens, updated_at, blocked_until, failures) = self._connect()
+        failures += 1
+        backoff = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** failures))
+        blocked_until = max(blocked_until, time.time() + backoff)
+        conn.execute(
+            "UPDATE rate_limit SET tokens = 0, blocked_until = ?, failures = ? WHERE provider = ?",
+            (blocked_until, failures, self.provider)
+        )
+        conn.execute("COMMIT")
+        conn.close()
+        logger.warning(f"{self.provider} is rate limited, backing off for {backoff:.1f}s")
+
+    def succeeded(self):
+        if not self.failures:
+            return
+        conn, row = self._connect()
+        conn.execute("UPDATE rate_limit SET failures = 0 WHERE provider = ?", (self.provider,))
+        conn.execute("COMMIT")
+        conn.close()
+        self.failures = 0
+
+# Call fn within the provider's rate limit, retrying rate limited and transient
+# errors with backoff. The last error is raised once the attempts run out.
+def with_rate_limit(provider, fn, max_attempts=MAX_ATTEMPTS):
+    limiter = RateLimiter(provider)
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_transient(e) or attempt == max_attempts - 1:
+                raise
+            note_retry()
+            if is_rate_limited(e):
+                limiter.rate_limited()
+            else:
+                backoff = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+                logger.warning(f"{provider} error: {e}, retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+            continue
+        limiter.succeeded()
+        return result
@@ -0,0 +1,356 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import math
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from utils.metrics import measure, metrics_context, flush
+logger = logging.getLogger(__name__)
+
+TITLE_DURATION = 3
+BACKGROUND_VOLUME = 0.075
+AUDIO_FORMAT = "aformat=sample_rates=44100:channel_layouts=stereo"
+
+# Full quality renders write final.mp4. Preview renders are downscaled, fast and
+# low bitrate, for checking pacing and images, and never overwrite the final files.
+RENDER_PROFILES = {
+    "final": {
+        "clip": "content-video-{id}.mp4",
+        "pre": "pre.mp4",
+        "output": "final.mp4",
+        "still": "content-still-{id}.mp4",
+        "track": "narration-{name}.m4a",
+        "variants_pre": "pre-variants.mp4",
+        "variants_output": "final-variants.mp4",
+        "title_clip": "title-clip.mp4",
+        "hls": "hls",
+        "scale": None,
+        "encoder_args": [],
+        "audio_bitrate": "192k",
+    },
+    "preview": {
+        "clip": "content-preview-{id}.mp4",
+        "pre": "pre-preview.mp4",
+        "output": "preview.mp4",
+        "still": "content-still-preview-{id}.mp4",
+        "track": "narration-preview-{name}.m4a",
+        "variants_pre": "pre-variants-preview.mp4",
+        "variants_output": "preview-variants.mp4",
+        "title_clip": "title-clip-preview.mp4",
+        "hls": "hls-preview",
+        "scale": "480:-2",
+        "encoder_args": ["-preset", "ultrafast", "-crf", "32"],
+        "audio_bitrate": "64k",
+    },
+}
+
+# Seconds an ffmpeg or ffprobe run may take before it is killed
+DEFAULT_FFMPEG_TIMEOUT = 1800
+PROBE_TIMEOUT = 60
+
+# Frame rate of still clips. Page lengths are rounded up to whole frames so the
+# narration tracks stay in step with the video over a long story.
+STILL_FRAME_RATE = 25
+
+# Target length of HLS segments. Still clips only have a keyframe every few
+# seconds, so segments are cut at the next keyframe after this.
+HLS_SEGMENT_SECONDS = 6
+
+# Images are normalized once to this size so every clip encode and re-stitch
+# decodes a small jpeg instead of the full size png
+NORMALIZED_SIZE = 1080
+NORMALIZE_FILTER = "scale={size}:{size}:force_original_aspect_ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+def get_clip_path(story_path, story_content_id, profile="final"):
+    return f"{story_path}/" + RENDER_PROFILES[profile]["clip"].format(id=story_content_id)
+
+def get_still_path(story_path, story_content_id, profile="final"):
+    return f"{story_path}/" + RENDER_PROFILES[profile]["still"].format(id=story_content_id)
+
+def get_track_path(story_path, name, profile="final"):
+    return f"{story_path}/" + RENDER_PROFILES[profile]["track"].format(name=name)
+
+def get_encode_workers():
+    encode_workers = os.getenv('ENCODE_WORKERS')
+    if encode_workers:
+        return max(1, int(encode_workers))
+    return os.cpu_count() or 1
+
+# A stuck encode fails its stage instead of hanging the build
+def get_ffmpeg_timeout():
+    return int(os.getenv('FFMPEG_TIMEOUT', DEFAULT_FFMPEG_TIMEOUT))
+
+# Run ffmpeg without a shell so paths never need quoting. The output file size
+# is recorded as bytes out.
+def run_ffmpeg(args, stage="ffmpeg"):
+    command = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"] + args
+    timeout = get_ffmpeg_timeout()
+    with measure(stage) as measurement:
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"ffmpeg did not finish within {timeout}s: {' '.join(command)}")
+        if result.returncode != 0:
+            measurement.outcome = "failed"
+            raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+        if os.path.exists(args[-1]):
+            measurement.bytes_out = os.path.getsize(args[-1])
+
+# Encode a still image and narration into a single page clip. Metrics are
+# flushed here as this also runs in pool worker processes.
+def encode_clip(image_path, audio_path, clip_path, story_id=None, story_content_id=None, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    scale_args = ["-vf", f"scale={settings['scale']}"] if settings["scale"] else []
+    with metrics_context(story_id, story_content_id):
+        run_ffmpeg([
+            "-loop", "1", "-i", image_path,
+            "-i", audio_path,
+            "-c:v", "libx264", "-tune", "stillimage",
+        ] + scale_args + settings["encoder_args"] + [
+            "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+            "-pix_fmt", "yuv420p", "-shortest",
+            clip_path
+        ], stage="ffmpeg_clip")
+    flush()
+    return clip_path
+
+# Length of a media file in seconds
+def probe_duration(path):
+    return float(run_ffprobe(["-show_entries", "format=duration", path]))
+
+# Width and height of the first video stream of a file
+def probe_video_size(path):
+    output = run_ffprobe(["-select_streams", "v:0", "-show_entries", "stream=width,height", path])
+    width, height = output.split()[:2]
+    return int(width), int(height)
+
+def run_ffprobe(args):
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-of", "default=noprint_wrappers=1:nokey=1"] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=PROBE_TIMEOUT
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+# The length of a page that fits its longest narration, in whole frames
+def get_page_duration(durations):
+    return math.ceil(max(durations) * STILL_FRAME_RATE) / STILL_FRAME_RATE
+
+# Encode a page image as a silent clip of a set length. Every narration of the
+# page plays over the same clip, so its video is only encoded once.
+def encode_still(image_path, duration, clip_path, story_id=None, story_content_id=None, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    scale_args = ["-vf", f"scale={settings['scale']}"] if settings["scale"] else []
+    with metrics_context(story_id, story_content_id):
+        run_ffmpeg([
+            "-loop", "1", "-framerate", str(STILL_FRAME_RATE), "-t", f"{duration:.3f}", "-i", image_path,
+            "-c:v", "libx264", "-tune", "stillimage",
+        ] + scale_args + settings["encoder_args"] + [
+            "-pix_fmt", "yuv420p", "-an",
+            clip_path
+        ], stage="ffmpeg_still")
+    flush()
+    return clip_path
+
+# Join the narration of every page into one audio track, padding each page with
+# silence to the length of its still clip. pages is a list of (audio_path, duration).
+def build_narration_track(pages, output_path, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    inputs = []
+    filters = []
+    for index, (audio_path, duration) in enumerate(pages):
+        inputs += ["-i", audio_path]
+        filters.append(f"[{index}:a]{AUDIO_FORMAT},apad,atrim=end={duration:.3f},asetpts=N/SR/TB[a{index}]")
+    filters.append("".join(f"[a{index}]" for index in range(len(pages))) + f"concat=n={len(pages)}:v=0:a=1[a]")
+    run_ffmpeg(inputs + [
+        "-filter_complex", ";".join(filters),
+        "-map", "[a]",
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+        output_path
+    ], stage="ffmpeg_track")
+    return output_path
+
+# Encode the title card as a silent clip, scaled like the page images, to open
+# and close a segmented story
+def encode_title_clip(title_image_path, clip_path, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    scale = f",scale={settings['scale']}" if settings["scale"] else ""
+    run_ffmpeg([
+        "-loop", "1", "-framerate", "25", "-t", str(TITLE_DURATION), "-i", title_image_path,
+        "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
+        "-vf", f"{NORMALIZE_FILTER.format(size=NORMALIZED_SIZE)}{scale}",
+        "-c:v", "libx264", "-tune", "stillimage",
+    ] + settings["encoder_args"] + [
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+        "-pix_fmt", "yuv420p", "-shortest",
+        clip_path
+    ], stage="ffmpeg_title")
+    return clip_path
+
+# Split an encoded clip into MPEG-TS segments and a playlist by stream copy
+def segment_clip(clip_path, playlist_path, segment_pattern, segment_seconds=HLS_SEGMENT_SECONDS):
+    run_ffmpeg([
+        "-i", clip_path,
+        "-c", "copy",
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "vod",
+        "-hls_segment_filename", segment_pattern,
+        playlist_path
+    ], stage="ffmpeg_segment")
+    return playlist_path
+
+def get_normalized_path(image_path):
+    return f"{os.path.splitext(image_path)[0]}-normalized.jpg"
+
+def is_normalized(image_path, normalized_path):
+    return bool(normalized_path) and os.path.exists(normalized_path) and os.path.exists(image_path) \
+        and os.path.getmtime(normalized_path) >= os.path.getmtime(image_path)
+
+# Use the normalized image for encoding when it is up to date with the original
+def get_encode_image_path(image_path, normalized_path):
+    return normalized_path if is_normalized(image_path, normalized_path) else image_path
+
+# Resize an image to fit the video resolution and save it as a fast decoding jpeg
+def normalize_image(image_path, normalized_path, size=NORMALIZED_SIZE):
+    run_ffmpeg([
+        "-i", image_path,
+        "-vf", NORMALIZE_FILTER.format(size=size),
+        "-q:v", "2",
+        normalized_path
+    ], stage="ffmpeg_normalize")
+    flush()
+    return normalized_path
+
+# Cut a section of an mp3 by stream copy, from start to end seconds or to the end of the file
+def cut_audio(source_path, output_path, start, end=None):
+    args = ["-i", source_path, "-ss", f"{start:.3f}"]
+    if end is not None:
+        args += ["-to", f"{end:.3f}"]
+    run_ffmpeg(args + ["-c", "copy", output_path], stage="ffmpeg_cut")
+    return output_path
+
+# A clip newer than all of its inputs was encoded after they last changed
+def clip_is_newer(clip_path, input_paths):
+    if not os.path.exists(clip_path):
+        return False
+    clip_mtime = os.path.getmtime(clip_path)
+    return all(os.path.exists(path) and os.path.getmtime(path) < clip_mtime for path in input_paths)
+
+# Workers are started from a clean server process rather than forked from this
+# one, which may be running api threads (such as under --serve) that hold locks
+# or buffered metrics at the moment of the fork
+def get_pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+# Run fn for each job tuple in a process pool sized to the machine, calling
+# on_done in this process with each job as soon as it finishes
+def run_in_pool(fn, jobs, on_done=None, max_workers=None):
+    if not jobs:
+        return
+    with ProcessPoolExecutor(max_workers=max_workers or get_encode_workers(), mp_context=get_pool_context()) as executor:
+        futures = {executor.submit(fn, *job): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                logger.info(f"Finished {future.result()}")
+                if on_done:
+                    on_done(futures[future])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+# Encode clips in parallel. jobs is a list of (image_path, audio_path,
+# clip_path, story_id, story_content_id, profile).
+def encode_clips(jobs, on_done=None, max_workers=None):
+    run_in_pool(encode_clip, jobs, on_done, max_workers)
+
+# Join page clips by stream copy. The concat list is a per-call temp file in
+# work_dir so several stories can be stitched at the same time.
+def concat_clips(clips, output_path, work_dir):
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", prefix="concat-", dir=work_dir, delete=False) as f:
+        for clip in clips:
+            escaped = os.path.abspath(clip).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    try:
+        run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path], stage="ffmpeg_concat")
+    finally:
+        os.remove(list_path)
+    return output_path
+
+# Render the final video in one streaming ffmpeg pass: the title card before and
+# after the story, with the looped background music mixed under the narration.
+# The title card is scaled to the size of the story clips, which is probed up
+# front as scale2ref stalls waiting on the looped title input.
+def render_final(title_image_path, story_video_path, music_path, output_path, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    width, height = probe_video_size(story_video_path)
+    filter_graph = (
+        f"[0:v]scale={width}:{height},setsar=1,format=yuv420p,split[intro][outro];"
+        "[1:v]setsar=1,format=yuv420p[body];"
+        f"anullsrc=channel_layout=stereo:sample_rate=44100,atrim=duration={TITLE_DURATION},asplit[intro_a][outro_a];"
+        f"[1:a]{AUDIO_FORMAT}[body_a];"
+        "[intro][intro_a][body][body_a][outro][outro_a]concat=n=3:v=1:a=1[v][narration];"
+        f"[2:a]volume={BACKGROUND_VOLUME},{AUDIO_FORMAT}[music];"
+        "[narration][music]amix=inputs=2:duration=first:normalize=0[a]"
+    )
+    run_ffmpeg([
+        "-loop", "1", "-framerate", "25", "-t", str(TITLE_DURATION), "-i", title_image_path,
+        "-i", story_video_path,
+        "-stream_loop", "-1", "-i", music_path,
+        "-filter_complex", filter_graph,
+        "-map", "[v]", "-map", "[a]",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+    ] + settings["encoder_args"] + [
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+        "-movflags", "+faststart",
+        output_path
+    ], stage="ffmpeg_final")
+    return output_path
+
+# Render the final video once with a narration track per voice. Every track
+# gets the title card silence and the background music, and is named after its
+# voice so players can switch between them. tracks is a list of (path, name)
+# with the default narration first.
+def render_final_tracks(title_image_path, story_video_path, tracks, music_path, output_path, profile="final"):
+    settings = RENDER_PROFILES[profile]
+    music_input = 2 + len(tracks)
+    width, height = probe_video_size(story_video_path)
+    filters = [
+        f"[0:v]scale={width}:{height},setsar=1,format=yuv420p,split[intro][outro]",
+        "[1:v]setsar=1,format=yuv420p[body]",
+        "[intro][body][outro]concat=n=3:v=1:a=0[v]",
+        f"[{music_input}:a]volume={BACKGROUND_VOLUME},{AUDIO_FORMAT},asplit={len(tracks)}"
+        + "".join(f"[music{index}]" for index in range(len(tracks))),
+    ]
+    inputs = [
+        "-loop", "1", "-framerate", "25", "-t", str(TITLE_DURATION), "-i", title_image_path,
+        "-i", story_video_path,
+    ]
+    maps = ["-map", "[v]"]
+    for index, (track_path, name) in enumerate(tracks):
+        inputs += ["-i", track_path]
+        filters += [
+            f"anullsrc=channel_layout=stereo:sample_rate=44100,atrim=duration={TITLE_DURATION},asplit[pre{index}][post{index}]",
+            f"[{2 + index}:a]{AUDIO_FORMAT}[narration{index}]",
+            f"[pre{index}][narration{index}][post{index}]concat=n=3:v=0:a=1[track{index}]",
+            f"[track{index}][music{index}]amix=inputs=2:duration=first:normalize=0[a{index}]",
+        ]
+        maps += ["-map", f"[a{index}]", f"-metadata:s:a:{index}", f"title={name}"]
+    run_ffmpeg(inputs + [
+        "-stream_loop", "-1", "-i", music_path,
+        "-filter_complex", ";".join(filters),
+    ] + maps + [
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+    ] + settings["encoder_args"] + [
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+        "-disposition:a:0", "default",
+        "-movflags", "+faststart",
+        output_path
+    ], stage="ffmpeg_final")
+    return output_path
@@ -0,0 +1,97 @@
+import json
+import math
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+# Session data ids must point at JSON, so players read the chapters from a JSON
+# chapter list. The WebVTT copy is for web players that take chapter tracks.
+CHAPTERS_DATA_ID = "com.apple.hls.chapters"
+
+# Read the (duration, segment file name) entries of a media playlist written by ffmpeg
+def read_media_playlist(path):
+    segments = []
+    duration = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((duration, os.path.basename(line)))
+                duration = None
+    return segments
+
+# Write one VOD playlist from the segments of each part in order. Every part was
+# segmented on its own and starts its timestamps again, so a discontinuity is
+# marked between parts.
+def write_story_playlist(path, parts):
+    target = max((math.ceil(duration) for part in parts for duration, _ in part), default=1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{target}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index, part in enumerate(parts):
+        if index:
+            lines.append("#EXT-X-DISCONTINUITY")
+        for duration, name in part:
+            lines += [f"#EXTINF:{duration:.3f},", name]
+    lines.append("#EXT-X-ENDLIST")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def format_timestamp(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+# Write a WebVTT chapter track with a cue for each (title, duration) part
+def write_chapters(path, chapters):
+    lines = ["WEBVTT", ""]
+    start = 0.0
+    for index, (title, duration) in enumerate(chapters):
+        end = start + duration
+        lines += [str(index + 1), f"{format_timestamp(start)} --> {format_timestamp(end)}", title, ""]
+        start = end
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+# Write a JSON chapter list with the start and length of each (title, duration) part
+def write_chapter_list(path, chapters, language="en"):
+    entries = []
+    start = 0.0
+    for index, (title, duration) in enumerate(chapters):
+        entries.append({
+            "chapter": index + 1,
+            "start-time": round(start, 3),
+            "duration": round(duration, 3),
+            "titles": [{"language": language, "title": title}],
+        })
+        start += duration
+    with open(path, "w") as f:
+        json.dump(entries, f, indent=2)
+
+# Write the playlist players open: the story playlist at its peak bit rate, and
+# the JSON chapter list as session data
+def write_master_playlist(path, playlist_name, chapters_name, bandwidth):
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f'#EXT-X-SESSION-DATA:DATA-ID="{CHAPTERS_DATA_ID}",URI="{chapters_name}"',
+        f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}",
+        playlist_name,
+    ]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+# Peak bits per second over the segments of every part, in the directory they were written to
+def get_peak_bandwidth(directory, parts):
+    peak = 0
+    for part in parts:
+        for duration, name in part:
+            if duration > 0:
+                peak = max(peak, os.path.getsize(os.path.join(directory, name)) * 8 / duration)
+    return math.ceil(peak)